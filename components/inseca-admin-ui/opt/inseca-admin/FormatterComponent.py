@@ -16,12 +16,12 @@
 #    along with INSECA.  If not, see <https://www.gnu.org/licenses/>
 
 import os
-import datetime
+import time
 import json
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import GObject
 from gi.repository import Gtk
+from gi.repository import GLib
 
 import MiscUI as mui
 import Configurations
@@ -29,27 +29,37 @@ import Jobs as jobs
 import Utils as util
 import PluggedDevices as pdev
 
-class Params(GObject.Object):
+class Params:
     """Object to manage the parameters which must be provided to format a storage device
     and the associated widgets in @ui"""
-    __gsignals__ = {
-        "data_changed": (GObject.SIGNAL_RUN_FIRST, None, ())
-    }
     def __init__(self, gconf, dconf, fconf):
-        GObject.Object.__init__(self)
-        if not isinstance(gconf, Configurations.GlobalConfiguration):
-            raise Exception("CODEBUG: invalid @gconf argument")
-        if not isinstance(dconf, Configurations.DomainConfig):
-            raise Exception("CODEBUG: invalid @dconf argument")
-        if not isinstance(fconf, Configurations.FormatConfig):
-            raise Exception("CODEBUG: invalid @iconf argument")
+        assert isinstance(gconf, Configurations.GlobalConfiguration), "CODEBUG: invalid @gconf argument"
+        assert isinstance(dconf, Configurations.DomainConfig), "CODEBUG: invalid @dconf argument"
+        assert isinstance(fconf, Configurations.FormatConfig), "CODEBUG: invalid @fconf argument"
         self._gconf=gconf
         self._dconf=dconf
         self._fconf=fconf
 
         self._init_parameters_sets()
 
-        self._links={}
+        # CORE parameters which don't change during the object's lifetime
+        self._fixed_core_params={
+            "fs-data": "exfat",
+            "confid": fconf.id,
+            "password-rescue": fconf.password_rescue,
+            "device-signing-private-key-file": os.path.basename(fconf.devicemeta_privkey)
+        }
+
+        # overrides, which can only apply to the generated parameters as the
+        # overridden parameters don't have any associated widget
+        core_pnames=self._generate_core_parameters().keys()
+        self._overrides={pname:value for (pname, value) in fconf.overrides.items() if pname in core_pnames}
+
+        self._param_widgets={} # key=parameter name, value=associated entry widget
+        self._widgets=[] # all the labels and entry widgets created in the UI
+        self._last_values=None # widgets' values used to compute self._last_ui_params
+        self._last_ui_params=None
+        self._changed_cb=None
 
     def _init_parameters_sets(self):
         """Initialize the parameters sets:
@@ -59,10 +69,7 @@ class Params(GObject.Object):
         core_params=self._fconf.parameters_core.copy()
 
         # "core" parameters which should be defined by the user (the others are defined automatically)
-        self._fconf_params={}
-        for pname in ["password-user", "fs-data", "enctype-data"]:
-            self._fconf_params[pname]=core_params[pname]
-            del core_params[pname]
+        self._fconf_params={pname:core_params.pop(pname) for pname in ("password-user", "fs-data", "enctype-data")}
 
         self._core_params=core_params
         self._fconf_params.update(self._fconf.parameters_config)
@@ -70,73 +77,99 @@ class Params(GObject.Object):
 
     def _generate_core_parameters(self):
         """Generate all the CORE parameters, from random values or fixed/contextual information"""
-        res={}
-        # fs
-        res["fs-data"]="exfat"
-        # config ID
-        res["confid"]=self._fconf.id
-        # creation-date
-        now=datetime.datetime.utcnow()
-        ts=int(datetime.datetime.timestamp(now))
-        res["creation-date"]=datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-        # creation-date-ts
+        # fs, config ID, password-rescue and device-signing-private-key-file
+        res=self._fixed_core_params.copy()
+        # creation-date and creation-date-ts
+        ts=int(time.time())
+        res["creation-date"]=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
         res["creation-date-ts"]=ts
-        # password-rescue
-        res["password-rescue"]=self._fconf.password_rescue
-        # device-signing-private-key-file
-        res["device-signing-private-key-file"]=os.path.basename(self._fconf.devicemeta_privkey)
         return res
 
-    def _compute_link_name(self, params_set, component, pname):
-        if params_set==self._core_params or params_set==self._fconf_params:
-            return "||%s"%pname
-        else:
-            return "userdata|%s|%s"%(component, pname)
-
-    def _get_widget_for_param(self, pname):
-        lname=self._compute_link_name(self._fconf_params, None, pname)
-        if lname in self._links:
-            return self._links[lname]
-        return None
-
-    def create_widgets(self, builder):
-        """Create the actual labels and entry widgets for all the parameters"""
+    def create_widgets(self, grid):
+        """Create the actual labels and entry widgets for all the parameters, in @grid"""
         top=2
-        grid=builder.get_object("format-grid")
 
         # config params
-        for pname in self._fconf_params:
-            if pname not in self._fconf.overrides:
-                pspec=self._fconf_params[pname]
-                label=mui.create_label_widget(pspec)
-                grid.attach(label, 0, top, 1, 1)
-                widget=mui.create_param_entry(pspec)
-                widget.connect("data_changed", self._data_changed_cb)
-                self._links[self._compute_link_name(self._fconf_params, None, pname)]=widget
-                grid.attach(widget, 1, top, 1, 1)
-                top+=1
-        grid.show_all()
+        attach=grid.attach
+        overrides=self._fconf.overrides
+        grid.freeze_child_notify()
+        try:
+            for (pname, pspec) in self._fconf_params.items():
+                if pname not in overrides:
+                    label=mui.create_label_widget(pspec)
+                    self._widgets.append(label)
+                    attach(label, 0, top, 1, 1)
+                    widget=mui.create_param_entry(pspec)
+                    self._widgets.append(widget)
+                    widget.connect("data_changed", self._data_changed_cb)
+                    self._param_widgets[pname]=widget
+                    attach(widget, 1, top, 1, 1)
+                    top+=1
+        except Exception:
+            # don't leave a partial form in @grid
+            self.destroy_widgets()
+            raise
+        finally:
+            grid.thaw_child_notify()
+        self.show_widgets()
+
+    def show_widgets(self):
+        for widget in self._widgets:
+            widget.show_all()
+
+    def hide_widgets(self):
+        self.clear_passwords()
+        for widget in self._widgets:
+            widget.hide()
+
+    def clear_passwords(self):
+        """Remove the passwords typed in the form"""
+        for widget in self._param_widgets.values():
+            if isinstance(widget, mui.PasswordEntry):
+                widget.clear()
+        self._last_values=None
+        self._last_ui_params=None
+
+    def destroy_widgets(self):
+        for widget in self._widgets:
+            widget.destroy()
+        self._widgets=[]
+        self._param_widgets={}
+
+    def set_changed_cb(self, callback):
+        """Define the function to call (with the Params object as argument) whenever a parameter's value
+        is changed in the UI (there is no GObject signal to avoid its emission cost for each keystroke)"""
+        self._changed_cb=callback
 
     def _data_changed_cb(self, widget):
-        self.emit("data_changed")
+        if self._changed_cb:
+            self._changed_cb(self)
+
+    def _get_ui_params(self):
+        """Get the parameters' values defined in the UI, computed again only if a widget's value has changed"""
+        values=tuple(widget.get_value() for widget in self._param_widgets.values())
+        if values!=self._last_values:
+            res={}
+            for (pname, value) in zip(self._param_widgets, values):
+                if value=="":
+                    raise Exception("%s: invalid empty value"%pname)
+                res[pname]=value
+            self._last_values=values
+            self._last_ui_params=res
+        return self._last_ui_params
+
+    def check_format_valued_params(self):
+        """Check that all the parameters defined in the UI are valid, raises an exception if not"""
+        self._get_ui_params()
 
     def get_format_valued_params(self):
         """Returns all the parameters required to format a device"""
         # core and from UI
         res=self._generate_core_parameters()
-        for pname in self._fconf_params:
-            widget=self._get_widget_for_param(pname)
-            if widget:
-                value=widget.get_value()
-                if value=="":
-                    raise Exception("%s: invalid empty value"%pname)
-                res[pname]=value
+        res.update(self._get_ui_params())
 
         # overrides
-        overrides=self._fconf.overrides
-        for pname in overrides:
-            if pname in res:
-                res[pname]=overrides[pname]
+        res.update(self._overrides)
 
         return res
 
@@ -155,7 +188,7 @@ class Component:
         self._form_grid=self._builder.get_object("format-grid")
         self._templates={} # key=@self._combo_template text, value: the associated [domain config, format config] objects list
         self._combo_template=self._builder.get_object("format-template")
-        self._combo_template.connect("changed", self._format_template_changed_cb)
+        self._combo_template_sid=self._combo_template.connect("changed", self._format_template_changed_cb)
         self._cancel_button=self._builder.get_object("cancel-button")
         self._back_button=self._builder.get_object("back-button")
 
@@ -167,17 +200,22 @@ class Component:
 
         self._internal_page_change=False
 
+        # global configuration, fetched when the templates list is (re)built
+        self._gconf=None
+
         # attributes updated when a format configuration is chosen via the UI
         self._dconf=None
         self._fconf=None
         self._params=None # will be a Params object when a format configuration has been chosen
+        self._forms={} # key=format configuration ID, value: the Params object managing its form
+        self._form_creation_id=None # GLib source ID of the pending form creation, if any
         self._final_params=None
         self._devfile=None
 
         # widgets in the form which need to be kept when the form changes (when the format config changes)
-        self._to_keep=[self._combo_device]
-        for label in ("format-device-label", "format-template", "format-template-label"):
-            self._to_keep+=[self._builder.get_object(label)]
+        self._to_keep={self._combo_device, self._combo_template}
+        for label in ("format-device-label", "format-template-label"):
+            self._to_keep.add(self._builder.get_object(label))
 
         # extra widgets
         bbox=builder.get_object("actions-bbox")
@@ -194,34 +232,57 @@ class Component:
             self._update_format_templates()
         else:
             self._format_button.hide()
+            if self._params and not self._internal_page_change:
+                # don't keep the passwords while the user is on another page
+                self._params.clear_passwords()
 
     def _update_format_templates(self):
         """Update the combo box to select among the list of format configurations available, and
-        update the associated self._templates"""
+        update the associated self._templates (only if the global configuration has been reloaded)"""
+        gconf=Configurations.get_gconf()
+        if gconf is self._gconf and self._templates:
+            # global configuration not reloaded since the last update => nothing to do
+            return
+        self._gconf=gconf
+        self._clear_forms()
+
         combo=self._combo_template
         current_template=combo.get_active_text()
+        combo.handler_block(self._combo_template_sid) # avoid resetting the form for each change
         combo.remove_all()
         self._templates={}
-        index=0
-        add_dom_prefix=True
-        gconf=Configurations.get_gconf()
-        if len(gconf.domain_configs)==1:
-            add_dom_prefix=False
-        for duid in gconf.domain_configs:
-            dconf=gconf.get_domain_conf(duid)
-            for iuid in dconf.format_ids:
-                iconf=gconf.get_format_conf(iuid)
-                if add_dom_prefix:
-                    text="%s - %s"%(dconf.descr, iconf.descr)
-                else:
-                    text=iconf.descr
-                combo.append_text(text)
-                self._templates[text]=[dconf, iconf]
-                if current_template==iconf.descr:
-                    combo.set_active(index)
-                index+=1
-        if index==1:
+        duids=gconf.domain_configs
+        dconf=gconf.get_domain_conf(duids[0]) if len(duids)==1 else None
+        if dconf and len(dconf.format_ids)==1:
+            # most common case: a single format configuration
+            iconf=gconf.get_format_conf(dconf.format_ids[0])
+            combo.append_text(iconf.descr)
+            self._templates[iconf.descr]=[dconf, iconf]
             combo.set_active(0)
+        else:
+            index=0
+            add_dom_prefix=len(duids)!=1
+            get_dconf=gconf.get_domain_conf
+            get_fconf=gconf.get_format_conf
+            append=combo.append_text
+            templates=self._templates
+            for duid in duids:
+                dconf=get_dconf(duid)
+                for iuid in dconf.format_ids:
+                    iconf=get_fconf(iuid)
+                    if add_dom_prefix:
+                        text="%s - %s"%(dconf.descr, iconf.descr)
+                    else:
+                        text=iconf.descr
+                    append(text)
+                    templates[text]=[dconf, iconf]
+                    if current_template==iconf.descr:
+                        combo.set_active(index)
+                    index+=1
+            if index==1:
+                combo.set_active(0)
+        combo.handler_unblock(self._combo_template_sid)
+        self._format_template_changed_cb(combo)
 
     def _format_template_changed_cb(self, widget):
         """Called when the selected format template has changed"""
@@ -231,31 +292,65 @@ class Component:
             (self._dconf, self._fconf)=self._templates[current_template]
         self._update_form()
 
-    def _update_form(self):
-        """Reset the format form (called after the format template has changed)"""
+    def _clear_forms(self):
+        """Remove all the forms created for the format configurations"""
         # remove all children of self._form_grid
         def torem(child, container):
             if child not in self._to_keep:
                 container.remove(child)
+        self._form_grid.freeze_child_notify()
         self._form_grid.foreach(torem, self._form_grid)
+        self._form_grid.thaw_child_notify()
+        for params in self._forms.values():
+            params.set_changed_cb(None)
+        self._forms={}
+        self._params=None
+
+    def _update_form(self, reset=False):
+        """Update the format form (called after the format template has changed), reusing the form
+        already created for the format configuration, unless @reset is True"""
+        if self._form_creation_id is not None:
+            GLib.source_remove(self._form_creation_id)
+            self._form_creation_id=None
+        self._format_button.set_sensitive(False)
+        if self._params:
+            # detach the previous form
+            self._params.set_changed_cb(None)
+            self._params.hide_widgets()
+            self._params=None
         if not self._fconf:
             return
 
-        # get the actual format informations
-        self._internal_page_change=True
-        self._ui.show_page("message")
+        if reset and self._fconf.id in self._forms:
+            self._forms.pop(self._fconf.id).destroy_widgets()
+        if self._fconf.id in self._forms:
+            self._params=self._forms[self._fconf.id]
+            self._params.set_changed_cb(self._params_changed_cb)
+            self._params.show_widgets()
+            self._params_changed_cb(None)
+            return
+
+        # create the form only if the selected format template does not change for a short while
+        # (the user may be going through the templates list)
+        self._form_creation_id=GLib.timeout_add(150, self._create_form, self._dconf, self._fconf)
+
+    def _create_form(self, dconf, fconf):
+        """Create the form for the @fconf format configuration"""
+        self._form_creation_id=None
+        # get the actual format informations (no need to switch to the "message" page
+        # as the widgets creation is synchronous and fast)
         try:
-            gconf=Configurations.get_gconf()
-            self._params=Params(gconf, self._dconf, self._fconf)
-            self._params.create_widgets(self._builder)
-            self._params.connect("data_changed", self._params_changed_cb)
+            params=Params(self._gconf, dconf, fconf)
+            params.create_widgets(self._form_grid)
+            params.set_changed_cb(self._params_changed_cb)
+            self._forms[fconf.id]=params
+            self._params=params
             self._params_changed_cb(None)
         except Exception as e:
             self._ui.show_error(str(e))
         finally:
             self._back_button.set_sensitive(True)
-            self._ui.show_page("format")
-            self._internal_page_change=False
+        return False # remove GLib's timer
 
     def _params_changed_cb(self, dummy):
         """Update the UI while the form elements are modified by the end user"""
@@ -265,12 +360,11 @@ class Component:
             # no format configuration selected
             return
         try:
-            pvalues=self._params.get_format_valued_params()
+            self._params.check_format_valued_params()
             self._devfile=self._combo_device.get_selected_devfile()
             if self._devfile is None:
                 raise Exception("No device selected")
 
-            self._final_params=pvalues
             self._error_message.hide()
             self._format_button.set_sensitive(True)
         except Exception as e:
@@ -287,11 +381,8 @@ class Component:
         self._ui.show_page("message")
         try:
             sid=None # safe init value
-            params_file=util.Temp(data=json.dumps(self._final_params))
-            if False:
-                # debug, to be removed
-                self._final_params["password-user"]="ChocolatChoco12"
-                open("/tmp/DEBUG-format.json", "w").write(json.dumps(self._final_params))
+            self._final_params=self._params.get_format_valued_params()
+            params_file=util.Temp(data=json.dumps(self._final_params, separators=(",", ":")))
             args=["--verbose", "dev-format", self._fconf.id, params_file.name, self._devfile]
             job=jobs.InsecaRunJob(args, "Formatting device", feedback_component=self._ui.feedback_component)
             job.start()
@@ -315,7 +406,7 @@ class Component:
                 self._cancel_button.disconnect(sid)
             self._ui.show_page("format")
             self._internal_page_change=False
-            self._update_form()
+            self._update_form(reset=True)
 
     def _cancel_job(self, widget, job):
         job.cancel()
\ No newline at end of file
@@ -86,6 +86,11 @@ class PasswordEntry(Gtk.VBox):
         pentry.connect("icon-release", self._icon_released, None)
         return pentry
 
+    def clear(self):
+        """Remove the typed password"""
+        self._pass0.set_text("")
+        self._pass1.set_text("")
+
     def get_value(self):
         p0=self._pass0.get_text()
         p1=self._pass1.get_text()
@@ -15,6 +15,10 @@
 #    You should have received a copy of the GNU General Public License
 
 import os
+import base64
+import lzma
+import subprocess
+import threading
 import logging
 import Utils as util
 import CryptoGen as crypto
@@ -98,14 +102,7 @@ class CryptoKey(crypto.Crypto):
 
         # generate random symetric key
         symkey=util.gen_random_bytes(32)
-
-        # encrypt symetric key with certificate's public key
-        pubtmp=util.Temp(self._pubkey)
-        args=["/usr/bin/openssl", "rsautl", "-encrypt", "-inkey", pubtmp.name, "-pubin"]
-        (status, out, err)=util.exec_sync(args, stdin_data=symkey, as_bytes=True)
-        if status!=0:
-            raise Exception (_("Could not encrypt symetric key with certificate's public key: %s")%err)
-        enc_key=crypto.data_encode_to_ascii(out)
+        enc_key=self._encrypt_symetric_key(symkey)
 
         # encrypt clear text data with symetric key
         args=["/usr/bin/openssl", "enc", "-a", "-A", "-aes-256-cbc", "-md", self._digest, "-in", data_fname, "-pass", "stdin"]
@@ -121,6 +118,79 @@ class CryptoKey(crypto.Crypto):
         else:
             return retval
 
+    def _encrypt_symetric_key(self, symkey):
+        """Encrypt the intermediate symetric key with the public key, encoded as expected by decrypt()"""
+        pubtmp=util.Temp(self._pubkey)
+        args=["/usr/bin/openssl", "rsautl", "-encrypt", "-inkey", pubtmp.name, "-pubin"]
+        (status, out, err)=util.exec_sync(args, stdin_data=symkey, as_bytes=True)
+        if status!=0:
+            raise Exception (_("Could not encrypt symetric key with certificate's public key: %s")%err)
+        return crypto.data_encode_to_ascii(out)
+
+    def encrypt_to_file(self, filename, writer):
+        """Same as encrypt() where the data to encrypt is written by the @writer function to the (binary) file object
+        it is passed, and the encrypted data is written to the @filename file as it is produced: neither the data
+        nor the encrypted data is entirely loaded in memory (use it for big data). The result can be decrypted using
+        decrypt() or decrypt_file_to_fd()"""
+        if not self._pubkey:
+            raise Exception(_("No public key provided, can't encrypt"))
+
+        # generate random symetric key, passed to openssl through a pipe
+        symkey=util.gen_random_bytes(32)
+        enc_key=self._encrypt_symetric_key(symkey)
+        (kread, kwrite)=os.pipe()
+        os.write(kwrite, ("%s\n"%symkey).encode())
+        os.close(kwrite)
+
+        # encrypt the data using the symetric key, applying the crypto.data_encode_to_ascii() encoding on the fly
+        # (always compressed, as the size of the data is not known in advance)
+        args=["/usr/bin/openssl", "enc", "-a", "-A", "-aes-256-cbc", "-md", self._digest, "-pass", "fd:%d"%kread]
+        proc=subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(kread,))
+        os.close(kread)
+        try:
+            with open(filename, "wb") as efile:
+                efile.write(("%s:%s:%s:S"%(self._digest, enc_key, "rsa")).encode())
+
+                encode_errors=[]
+                def encode():
+                    try:
+                        compressor=lzma.LZMACompressor(lzma.FORMAT_XZ)
+                        data=b""
+                        while True:
+                            chunk=proc.stdout.read(1048576)
+                            data+=compressor.compress(chunk) if chunk else compressor.flush()
+                            size=len(data) if not chunk else len(data)-len(data)%3 # base64 is encoded by blocks of 3 bytes
+                            efile.write(base64.b64encode(data[:size]))
+                            data=data[size:]
+                            if not chunk:
+                                break
+                    except Exception as e:
+                        # stop openssl so the writer gets an EPIPE instead of blocking on a full pipe
+                        encode_errors.append(e)
+                        proc.kill()
+                encoder=threading.Thread(target=encode)
+                encoder.start()
+                try:
+                    writer(proc.stdin)
+                except BrokenPipeError:
+                    pass # openssl failed, see below
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                    encoder.join()
+                    err=proc.stderr.read().decode()
+                    proc.wait()
+            if encode_errors:
+                raise encode_errors[0]
+            if proc.returncode!=0:
+                raise Exception (_("Could not encrypt data with symetric key: %s")%err)
+        except Exception:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+
     def decrypt(self, data, return_tmpobj=False):
         # retreive the different parts
         if not self._privkey:
@@ -129,18 +199,10 @@ class CryptoKey(crypto.Crypto):
         (digest, enc_key, algo, enc_data)=data.split(":")
         if enc_key=="" or enc_data=="":
             raise Exception(_("Invalid format for data to decrypt '%s'")%data)
-        enc_key=crypto.data_decode_from_ascii(enc_key)
         enc_data=crypto.data_decode_from_ascii(enc_data)
 
         # decrypt symetric key (using the RSA algo)
-        itmp=util.Temp(enc_key)
-        privkey_tmp=util.Temp(self._privkey)
-        args=["/usr/bin/openssl", "rsautl", "-decrypt", "-inkey", privkey_tmp.name, "-passin", "fd:0", "-in", itmp.name]
-        (status, symkey, err)=util.exec_sync(args, "\n")
-        itmp=None
-        privkey_tmp=None
-        if status!=0:
-            raise Exception (_("Could not decrypt intermediate symetric key: %s")%err)
+        symkey=self._decrypt_symetric_key(enc_key)
 
         # decrypt the actual data using the symetric key
         itmp=util.Temp(enc_data)
@@ -157,6 +219,73 @@ class CryptoKey(crypto.Crypto):
         else:
             return out
 
+    def _decrypt_symetric_key(self, enc_key):
+        """Decrypt the intermediate symetric key (as encoded by encrypt()) using the private key"""
+        itmp=util.Temp(crypto.data_decode_from_ascii(enc_key))
+        privkey_tmp=util.Temp(self._privkey)
+        args=["/usr/bin/openssl", "rsautl", "-decrypt", "-inkey", privkey_tmp.name, "-passin", "fd:0", "-in", itmp.name]
+        (status, symkey, err)=util.exec_sync(args, "\n")
+        if status!=0:
+            raise Exception (_("Could not decrypt intermediate symetric key: %s")%err)
+        return symkey
+
+    def decrypt_file_to_fd(self, filename, fd):
+        """Same as decrypt() for the encrypted data stored in the @filename file, except that the decrypted data is
+        written to the @fd file descriptor as it is decrypted: neither the encrypted nor the decrypted data is entirely
+        loaded in memory (use it for big files)"""
+        if not self._privkey:
+            raise Exception("No private key provided, can't decrypt")
+
+        with open(filename, "rb") as efile:
+            # read the "<digest>:<encrypted symetric key>:<algo>:" header
+            data=b""
+            while data.count(b":")<3:
+                chunk=efile.read(65536)
+                if not chunk:
+                    raise Exception(_("Invalid format for data to decrypt in '%s'")%filename)
+                data+=chunk
+            (digest, enc_key, algo, data)=data.split(b":", 3)
+            if not data:
+                data=efile.read(65536)
+            if enc_key==b"" or data==b"" or data[:1] not in (b"s", b"S", b"b", b"B"):
+                raise Exception(_("Invalid format for data to decrypt in '%s'")%filename)
+
+            # decrypt symetric key (using the RSA algo), passed to openssl through a pipe
+            symkey=self._decrypt_symetric_key(enc_key.decode())
+            (kread, kwrite)=os.pipe()
+            os.write(kwrite, ("%s\n"%symkey).encode())
+            os.close(kwrite)
+
+            # decrypt the actual data using the symetric key, undoing the crypto.data_encode_to_ascii() encoding on the fly
+            args=["/usr/bin/openssl", "enc", "-d", "-a", "-A", "-aes-256-cbc", "-md", digest.decode(), "-pass", "fd:%d"%kread]
+            proc=subprocess.Popen(args, stdin=subprocess.PIPE, stdout=fd, stderr=subprocess.PIPE, pass_fds=(kread,))
+            os.close(kread)
+            try:
+                decompressor=lzma.LZMADecompressor() if data[:1] in (b"S", b"B") else None
+                data=data[1:]
+                while True:
+                    chunk=efile.read(1048576)
+                    data+=chunk
+                    size=len(data) if not chunk else len(data)-len(data)%4 # base64 is decoded by blocks of 4 chars
+                    plain=base64.b64decode(data[:size])
+                    data=data[size:]
+                    if decompressor and plain:
+                        plain=decompressor.decompress(plain)
+                    proc.stdin.write(plain)
+                    if not chunk:
+                        break
+            except BrokenPipeError:
+                pass # openssl failed, see below
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                err=proc.stderr.read().decode()
+                proc.wait()
+            if proc.returncode!=0:
+                raise Exception (_("Could not decrypt data using symetric key: %s")%err)
+
     def sign(self, data, return_tmpobj=False):
         if not self._privkey:
             raise Exception(_("No private key provided, can't sign"))
@@ -33,7 +33,7 @@ def compute_file_hash(filename, start_byte=0, end_byte=None, hash_algo="sha256")
         if end_byte<start_byte:
             raise Exception("@end_byte is lower than @start_byte")
 
-    BUF_SIZE = 524288 # 512kb chunks
+    BUF_SIZE = 4194304 # 4Mb chunks
     time.sleep(0.1) # we may have "permission denied" otherwise!!!
 
     if end_byte is None:
@@ -46,19 +46,21 @@ def compute_file_hash(filename, start_byte=0, end_byte=None, hash_algo="sha256")
         sha256=hashlib.sha256()
     else:
         raise Exception("Unhandled hash algorithm '%s'"%hash_algo)
+    size=None if end_byte is None else end_byte-start_byte
     bytesread=0
-    with open(filename, 'rb') as f:
+    with open(filename, 'rb', buffering=0) as f:
+        # data is read directly in a single buffer (no intermediate copy)
+        os.posix_fadvise(f.fileno(), start_byte, size or 0, os.POSIX_FADV_SEQUENTIAL)
         if start_byte>0:
-            data=f.seek(start_byte)
-        while True:
-            to_read=BUF_SIZE
-            if end_byte is not None and bytesread+BUF_SIZE>=(end_byte-start_byte):
-                to_read=end_byte-start_byte-bytesread
-
-            data=f.read(to_read)
-            if data:
-                sha256.update(data)
-                bytesread+=len(data)
+            f.seek(start_byte)
+        buf=bytearray(BUF_SIZE if size is None else max(1, min(size, BUF_SIZE)))
+        view=memoryview(buf)
+        while size is None or bytesread<size:
+            to_read=len(buf) if size is None else min(len(buf), size-bytesread)
+            nb=f.readinto(view[:to_read])
+            if nb:
+                sha256.update(view[:nb])
+                bytesread+=nb
             else:
                 break
     return sha256.hexdigest()
@@ -72,21 +74,29 @@ def chain_integity_hash(hash0, hash1):
 def compute_partitions_table_hash(devfile, disktype):
     """Compute the hash of the partitions table"""
     #print("@Computing partitions table hash")
+    if disktype==util.LabelType.DOS:
+        size=512
+    elif disktype in (util.LabelType.GPT, util.LabelType.HYBRID):
+        size=34*512 # MBR + GPT header and entries
+    else:
+        raise Exception("Unknown partitioning type '%s'"%disktype)
+
+    # read everything at once
+    buf=bytearray(size)
+    view=memoryview(buf)
+    nb=0
+    with open(devfile, 'rb', buffering=0) as f:
+        while nb<size:
+            count=f.readinto(view[nb:])
+            if not count:
+                break
+            nb+=count
+
+    # we need to ignore the MBR signature from bytes 0x1b8 to 0x1bb included (4 bytes) because of Windows crap
     sha256=hashlib.sha256()
-    with open(devfile, 'rb') as f: # we need to ignore the MBR signature from bytes 0x1b8 to 0x1bb included (4 bytes) because of Windows crap
-        data=f.read(440)
-        sha256.update(data)
-        f.seek(444)
-        data=f.read(512-444)
-        sha256.update(data)
-        if disktype==util.LabelType.DOS:
-            h=sha256.hexdigest()
-        elif disktype in (util.LabelType.GPT, util.LabelType.HYBRID):
-            data=f.read(33*512)
-            sha256.update(data)
-            h=sha256.hexdigest()
-        else:
-            raise Exception("Unknown partitioning type '%s'"%disktype)
+    sha256.update(view[:min(nb, 440)])
+    sha256.update(view[444:nb])
+    h=sha256.hexdigest()
 
     return "%s|%s"%("sha256", h)
 
@@ -188,8 +198,33 @@ def _compute_efi_image_hash(filename, hash_obj):
         if status!=0:
             raise Exception("Could not unmount '%s': %s"%(filename, err))
 
-def _update_directory_hash(root, hash_obj, subfile, ignore_func=None):
-    """Internal function which 'updates' @hash_obj"""
+_file_hash_bufsize=2**20
+def _update_file_hash(filename, hash_obj, buf):
+    """Update @hash_obj with the contents of @filename, read directly (no intermediate copy)
+    in the @buf memoryview, reused from one file to the other"""
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            size=f.readinto(buf)
+            if size:
+                hash_obj.update(buf[:size])
+            else:
+                break
+
+class _PathEntry:
+    """Minimal os.DirEntry like object for a path which has not been obtained from os.scandir()"""
+    def __init__(self, path):
+        self.path=path
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+def _update_directory_hash(root, hash_obj, subfile, ignore_func=None, entry=None, buf=None):
+    """Internal function which 'updates' @hash_obj.
+    @entry is the os.DirEntry object of @subfile, if known, to avoid querying the file's type, and
+    @buf is the buffer used to read the files' contents (allocated once for the whole walk if not specified)"""
     if subfile and subfile[0]=="/":
         subfile=subfile[1:]
     filename="%s/%s"%(root, subfile)
@@ -200,15 +235,18 @@ def _update_directory_hash(root, hash_obj, subfile, ignore_func=None):
     elif basename in _manufacturers_crap_directories:
         _update_manufacturers_crap_directories_hash(filename, hash_obj)
     elif ignore_func is None or not ignore_func(root, subfile):
-        if os.path.isdir(filename):
+        if entry is None:
+            entry=_PathEntry(filename)
+        if entry.is_dir():
             #print("Directory [%s]"%subfile)
             hash_obj.update(("D"+subfile).encode())
-            flist=os.listdir(filename)
-            if flist:
-                flist.sort()
-                for sub in flist:
-                    _update_directory_hash(root, hash_obj, "%s/%s"%(subfile, sub), ignore_func)
-        elif os.path.islink(filename):
+            with os.scandir(filename) as it:
+                entries=sorted(it, key=lambda sub: sub.name)
+            for sub in entries:
+                if buf is None:
+                    buf=memoryview(bytearray(_file_hash_bufsize))
+                _update_directory_hash(root, hash_obj, "%s/%s"%(subfile, sub.name), ignore_func, sub, buf)
+        elif entry.is_symlink():
             #print("Link [%s]"%subfile)
             hash_obj.update(("L"+subfile).encode())
             hash_obj.update(os.readlink(filename).encode())
@@ -218,14 +256,9 @@ def _update_directory_hash(root, hash_obj, subfile, ignore_func=None):
             if basename.lower()=="efi.img":
                 _compute_efi_image_hash(filename, hash_obj)
             else:
-                BUF_SIZE=2**16
-                with open(filename, 'rb') as f:
-                    while True:
-                        data=f.read(BUF_SIZE)
-                        if data:
-                            hash_obj.update(data)
-                        else:
-                            break
+                if buf is None:
+                    buf=memoryview(bytearray(_file_hash_bufsize))
+                _update_file_hash(filename, hash_obj, buf)
 
 def compute_directory_hash(filename, ignore_func=None):
     """Compute a "kind of" hash of all the files and directories recursively,
@@ -17,12 +17,23 @@
 
 import uuid
 import json
-import gc
 import os
+import errno
+import re
+import glob
+import struct
+import threading
+import atexit
+import time
+import mmap
+import functools
+import contextlib
 import shutil
-import tempfile
+import subprocess
+import concurrent.futures
 import datetime
 import tarfile
+import tempfile
 import pwd
 import syslog
 import Device
@@ -52,6 +63,27 @@ def _get_run_dir():
     os.makedirs(rundir, exist_ok=True)
     return rundir
 
+@functools.lru_cache(maxsize=32)
+def _load_file_contents_cached(filename, mtime_ns, size, binary):
+    return util.load_file_contents(filename, binary)
+
+def _load_file_contents(filename, binary=False):
+    """Same as util.load_file_contents(), except that the file is actually read only
+    if it has been modified since it was last read (modification time or size changed).
+    The contents is kept in memory: don't use it for secrets"""
+    st=os.stat(filename)
+    return _load_file_contents_cached(filename, st.st_mtime_ns, st.st_size, binary)
+
+@functools.lru_cache(maxsize=32)
+def _load_json_file_cached(filename, mtime_ns, size):
+    return json.loads(util.load_file_contents(filename, binary=True))
+
+def _load_json_file(filename):
+    """Load and parse a JSON file, only if it has been modified since it was last loaded
+    (modification time or size changed). The returned data MUST NOT be modified"""
+    st=os.stat(filename)
+    return _load_json_file_cached(filename, st.st_mtime_ns, st.st_size)
+
 def _dummy_ignore(root, relative):
     """Ensure that the encrypted internal password file is not too big"""
     #util.print_event("RELATIVE_du: %s"%relative)
@@ -71,12 +103,11 @@ def _efi_ignore(root, relative):
     if relative=="boot/grub/bootparams.cfg":
         # contents must be equal to either bootparams0.cfg or bootparams1.cfg
         contents=util.load_file_contents("%s/%s"%(root, relative))
-        f0="%s/bootparams0.cfg"%root
-        f1="%s/bootparams1.cfg"%root
-        if not os.path.exists(f0) or not os.path.exists(f1):
+        try:
+            c0=util.load_file_contents("%s/bootparams0.cfg"%root)
+            c1=util.load_file_contents("%s/bootparams1.cfg"%root)
+        except FileNotFoundError:
             return cgen.generate_password() # force the process to fail
-        c0=util.load_file_contents(f0)
-        c1=util.load_file_contents(f1)
         if contents!=c0 and contents!=c1:
             return cgen.generate_password() # force the process to fail
         #util.print_event("IGNORED")
@@ -86,6 +117,7 @@ def _efi_ignore(root, relative):
 #
 # Misc.
 #
+_gdm_autologin_re=re.compile(r"^(AutomaticLoginEnable|TimedLoginEnable)=[^=\n]*$", re.M)
 def deactivate_gdm_autologin():
     """Make sure GDM's autologin is turned off (if GDM is present)"""
     gdmconf_file="/etc/gdm3/daemon.conf"
@@ -93,14 +125,7 @@ def deactivate_gdm_autologin():
         return
 
     econf=util.load_file_contents(gdmconf_file)
-    nconf=[]
-    for line in econf.splitlines():
-        parts=line.split("=")
-        if len(parts)==2 and parts[0] in ("AutomaticLoginEnable", "TimedLoginEnable"):
-            nconf+=["%s=false"%parts[0]]
-        else:
-            nconf+=[line]
-    nconf="\n".join(nconf)
+    nconf=_gdm_autologin_re.sub(r"\1=false", econf)
     util.write_data_to_file(nconf, gdmconf_file)
     (status, out, err)=util.exec_sync(["systemctl", "reload", "gdm"])
     if status==0:
@@ -117,35 +142,43 @@ def compute_integrity_fingerprint(dev, blob1_priv, live_hash):
     if not isinstance(blob1_priv, str):
         raise Exception("CODEBUG: invalid @blob1_priv: expected an str")
 
-    # inter partitions data
-    util.print_event("Hashing inter partitions data")
-    (interhash, log)=dev.compute_inter_partitions_hash()
+    # "dummy" and "EFI" partitions' contents are hashed in the background while the raw device is hashed
+    # (hashlib releases the GIL)
+    dummy_mp=dev.mount(partid_dummy)
+    efi_mp=dev.mount(partid_efi)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        util.print_event("Hashing 'dummy' partition data")
+        dummy_future=executor.submit(fphash.compute_directory_hash, dummy_mp, _dummy_ignore)
+        util.print_event("Hashing 'EFI' partition data")
+        efi_future=executor.submit(fphash.compute_directory_hash, efi_mp, _efi_ignore)
+
+        # inter partitions data
+        util.print_event("Hashing inter partitions data")
+        (interhash, log)=dev.compute_inter_partitions_hash()
+
+        # partitions table data
+        util.print_event("Hashing MBR/GPT data")
+        layout=dev.get_partitions_layout()
+        ftype=util.LabelType(layout["type"])
+        mbrhash=fphash.compute_partitions_table_hash(dev.devfile, ftype)
+
+        dummyhash=dummy_future.result()
+        efihash=efi_future.result()
 
     # add blob1's private key
-    import hashlib
-    sha256=hashlib.sha256()
-    sha256.update(blob1_priv.encode())
     hash=fphash.chain_integity_hash(interhash, blob1_priv)
     log+=[{"blob1": hash[:5]}]
 
     # partitions table data
-    util.print_event("Hashing MBR/GPT data")
-    layout=dev.get_partitions_layout()
-    ftype=util.LabelType(layout["type"])
-    newhash=fphash.compute_partitions_table_hash(dev.devfile, ftype)
-    hash=fphash.chain_integity_hash(hash, newhash)
+    hash=fphash.chain_integity_hash(hash, mbrhash)
     log+=[{"mbr": hash[:5]}]
 
     # "dummy" partition's contents
-    util.print_event("Hashing 'dummy' partition data")
-    newhash=fphash.compute_directory_hash(dev.mount(partid_dummy), _dummy_ignore)
-    hash=fphash.chain_integity_hash(hash, newhash)
+    hash=fphash.chain_integity_hash(hash, dummyhash)
     log+=[{"dummy": hash[:5]}]
 
     # "EFI" partition's contents
-    util.print_event("Hashing 'EFI' partition data")
-    newhash=fphash.compute_directory_hash(dev.mount(partid_efi), _efi_ignore)
-    hash=fphash.chain_integity_hash(hash, newhash)
+    hash=fphash.chain_integity_hash(hash, efihash)
     log+=[{"efi-data": hash[:5]}]
 
     # FIXME: add "internal" and "data" canaries's data
@@ -155,6 +188,40 @@ def compute_integrity_fingerprint(dev, blob1_priv, live_hash):
     log+=[{"live": hash[:5]}]
     return (hash, log)
 
+def _copy_big_file(srcfile, dstfile):
+    """Copy a (possibly big) file, the data being copied by the kernel without any user space buffer
+    (using copy_file_range() which can even avoid copying the data on some filesystems, or sendfile()).
+    The kernel is also told that the source file is read sequentially and that the copied data won't
+    be needed again soon (to avoid evicting the page cache of the running system)"""
+    with open(srcfile, "rb") as fsrc, open(dstfile, "wb") as fdst:
+        infd=fsrc.fileno()
+        outfd=fdst.fileno()
+        os.posix_fadvise(infd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        size=os.fstat(infd).st_size
+        offset=0
+        use_copy_file_range=hasattr(os, "copy_file_range")
+        while offset<size:
+            count=min(size-offset, 2**30)
+            if use_copy_file_range:
+                try:
+                    copied=os.copy_file_range(infd, outfd, count, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise e
+                    # not supported between these files: sendfile() writes at the output file's position, which
+                    # copy_file_range() (with explicit offsets) did not move
+                    use_copy_file_range=False
+                    os.lseek(outfd, offset, os.SEEK_SET)
+                    continue
+            else:
+                copied=os.sendfile(outfd, infd, offset, count)
+            if copied==0:
+                break
+            offset+=copied
+        os.fdatasync(outfd)
+        os.posix_fadvise(infd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(outfd, 0, 0, os.POSIX_FADV_DONTNEED)
+
 def install_live_linux_files_from_iso(live_path, source_dir):
     """Installs a new version of the Live Linux system (kernel + initrd + squash filesystem) in the @live_path (which must have been previously mounted).
     The resources are supposed to be all in @source_dir.
@@ -163,14 +230,19 @@ def install_live_linux_files_from_iso(live_path, source_dir):
     os.chmod(live_path, 0o700)
     util.print_event("Installing live Linux components")
 
+    # files to copy: (name, source file, destination file)
+    files=[(fname, "%s/live/%s"%(source_dir, fname), "%s/%s"%(live_path, fname)) for fname in ("vmlinuz", "initrd.img", "filesystem.squashfs")]
+
+    # existing files
+    with os.scandir(live_path) as it:
+        existing={entry.name: entry for entry in it}
+
     # make sure we have enough space to copy files
     free_b=shutil.disk_usage(live_path).free
-    for fname in ["vmlinuz", "initrd.img", "filesystem.squashfs"]:
-        srcfile="%s/live/%s"%(source_dir, fname)
-        dstfile="%s/%s"%(live_path, fname)
-        if os.path.exists(dstfile):
+    for (fname, srcfile, dstfile) in files:
+        if fname in existing:
             # dstfile will be overwriten => space it currently occupies will be made available
-            free_b+=os.stat(dstfile).st_size
+            free_b+=existing[fname].stat().st_size
         free_b-=os.stat(srcfile).st_size
     free_b-=+500*1024 # keep 500K for misc. filesystem housekeeping
     if free_b<=0:
@@ -178,16 +250,13 @@ def install_live_linux_files_from_iso(live_path, source_dir):
     syslog.syslog(syslog.LOG_INFO, "Live Linux update: %s bytes will remain after files installation"%free_b)
 
     # remove any existing file in the new directory
-    for filename in os.listdir(live_path):
-        fpath="%s/%s"%(live_path, filename)
-        os.remove(fpath)
+    for entry in existing.values():
+        os.remove(entry.path)
 
     # copy live Linux files
-    for fname in ["vmlinuz", "initrd.img", "filesystem.squashfs"]:
+    for (fname, srcfile, dstfile) in files:
         util.print_event("Copying the '%s' component to device"%fname)
-        srcfile="%s/live/%s"%(source_dir, fname)
-        dstfile="%s/%s"%(live_path, fname)
-        shutil.copyfile(srcfile, dstfile)
+        _copy_big_file(srcfile, dstfile)
 
 class InvalidCredentialException(Exception):
     pass
@@ -210,6 +279,87 @@ class UpdatesStatus(str, enum.Enum):
     STAGE = "Staging update"
     APPLY = "Applying staged update"
 
+def _decrypt_blob0_slots(user_password, salt, slots):
+    """Try to decrypt the blob0 of some blob0.json file's entries which all use the same @salt, using the user's password
+    (which is hardened only once). @slots is a list of (slot, entry) tuples.
+    Returns the list of (slot, blob0 as a string) tuples for the entries the password matches, in the @slots order"""
+    try:
+        password=cpass.harden_password_for_blob0(user_password, salt)
+        eobj=cpass.CryptoPassword(password)
+    except Exception:
+        eobj=None
+    eobj0=None
+    res=[]
+    for (slot, entry) in slots:
+        encdata=entry["enc-blob"]
+        try:
+            res.append((slot, eobj.decrypt(encdata).decode()))
+            continue
+        except Exception:
+            pass
+        if "salt" not in entry:
+            # for INSECA created before using the password hardening
+            try:
+                if eobj0 is None:
+                    eobj0=cpass.CryptoPassword(user_password, ignore_password_strength=True)
+                res.append((slot, eobj0.decrypt(encdata).decode()))
+            except Exception:
+                pass
+    return res
+
+def _bind_data_directory(key, dest):
+    """Bind mount the @key directory of the /data partition to @dest"""
+    src="/data/%s"%key
+    if not os.path.exists(src):
+        if os.path.exists(dest):
+            # initialize @src with @dest's contents before "replacing it" (via the bind mount)
+            shutil.copytree(dest, src)
+        else:
+            raise Exception("Could not bind 'data/%s': directories don't exist"%key)
+    os.makedirs(dest, exist_ok=True)
+    syslog.syslog(syslog.LOG_INFO, "Binding %s to %s"%(src, dest))
+    (status, out, err)=util.exec_sync(["mount", "--bind", "-o", "x-gvfs-hide", src, dest])
+    if status!=0:
+        raise Exception("Could not bind 'data/%s' to '%s': %s"%(src, dest, err))
+
+def _unbind_data_directory(key, dest):
+    """Undo _bind_data_directory()"""
+    syslog.syslog(syslog.LOG_INFO, "Unbinding %s"%dest)
+    (status, out, err)=util.exec_sync(["umount", dest])
+    if status!=0:
+        raise Exception("Could not unbind '%s': %s"%(dest, err))
+
+def _paths_overlap(path1, path2):
+    """Tell if @path1 and @path2 are the same or if one is inside the other"""
+    return path1==path2 or path1.startswith(path2.rstrip("/")+"/") or path2.startswith(path1.rstrip("/")+"/")
+
+def _run_data_map_batches(data_map, func):
+    """Call @func(key, dest) for each entry of the @data_map, concurrently (to overlap the mount or umount
+    processes' execution) for entries which don't interfere with each other. Entries involving a path which is
+    the same as, or inside, the source or destination of a previous entry (or the reverse) are handled after it,
+    as in a sequential execution (e.g. a source directory may be created from its destination's contents)"""
+    batches=[]
+    batch_paths=None
+    for key in data_map:
+        src=os.path.normpath("/data/%s"%key)
+        dest=os.path.normpath(data_map[key])
+        if batch_paths is None or \
+           any(_paths_overlap(src, bsrc) or _paths_overlap(dest, bsrc) or _paths_overlap(dest, bdest) or _paths_overlap(src, bdest)
+               for (bsrc, bdest) in batch_paths):
+            batches.append([])
+            batch_paths=[]
+        batches[-1].append(key)
+        batch_paths.append((src, dest))
+
+    for batch in batches:
+        if len(batch)==1:
+            func(batch[0], data_map[batch[0]])
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(batch))) as executor:
+                futures=[executor.submit(func, key, data_map[key]) for key in batch]
+            for future in futures:
+                future.result() # re-raise any exception
+
 class BootProcessWKS:
     """Class to help asserting integrity of a "workstation" device. See the Installer object to understand the operations
     performed here"""
@@ -240,50 +390,60 @@ class BootProcessWKS:
     def __del__(self):
         """Call this function when done"""
         self._dev=None
-        gc.collect()
 
     def _unlock_blob0(self, user_password):
         """Get the blob0 from the user's password, and retreives information about user.
         Returns the blob0 (as a string)"""
         # blob0 might contain something like: {"d3a96fec-d9f4-4a77-bc10-ce8f88796cd8": {"mode": "password", "salt": "I4&G...e\\m", "enc-blob": "sha256:sVTJ...T0=", "cn": "Firstname Lastname"}}
-        eobj0=cpass.CryptoPassword(user_password, ignore_password_strength=True)
         mp=self._dev.mount(partid_dummy)
-        blobs=json.loads(util.load_file_contents("%s/resources/blob0.json"%mp))
+        blobs=_load_json_file("%s/resources/blob0.json"%mp)
+
+        # group the slots by salt so the password is hardened only once per salt
+        salts={}
         for slot in blobs:
             entry=blobs[slot]
-            encdata=entry["enc-blob"]
+            salt=entry.get("salt", "not really some salt") # for INSECA created before using the password hardening with salt
+            salts.setdefault(salt, []).append((slot, entry))
+
+        # try all the slots, in parallel if there are several salts (the password hardening is CPU intensive
+        # and releases the GIL, and the decryption is done by an openssl process)
+        res=[]
+        if len(salts)==1:
+            for salt in salts:
+                res=_decrypt_blob0_slots(user_password, salt, salts[salt])
+        elif len(salts)>1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(salts), os.cpu_count() or 1)) as executor:
+                futures=[executor.submit(_decrypt_blob0_slots, user_password, salt, salts[salt]) for salt in salts]
+            for future in futures:
+                res+=future.result()
+
+        # use the first matching slot, in the blob0.json file's order
+        order={slot: index for (index, slot) in enumerate(blobs)}
+        for (slot, blob0) in sorted(res, key=lambda item: order[item[0]]):
             try:
-                try:
-                    if "salt" in entry:
-                        salt=entry["salt"]
-                    else:
-                        salt="not really some salt" # for INSECA created before using the password hardening with salt
-                    password=cpass.harden_password_for_blob0(user_password, salt)
-                    eobj=cpass.CryptoPassword(password)
-                    blob0=eobj.decrypt(encdata).decode()
-                except Exception:
-                    blob0=eobj0.decrypt(encdata).decode()
                 self._user_uuid=slot
                 util.write_data_to_file(slot, "%s/user_uuid"%_get_run_dir())
-                self._cn=entry["cn"]
+                self._cn=blobs[slot]["cn"]
 
                 # change user's comment, for the UI
                 if self._live_env.logged is not None:
                     util.change_user_comment(self._live_env.logged, self._cn)
                 return blob0
-            except Exception as e:
+            except Exception:
                 pass
+
         self._dev.umount(partid_dummy)
         raise InvalidCredentialException("Invalid password")
 
     def _unblock_with_blob0(self, dummy_mountpoint, blob0):
         # Use blob0 to decrypt blob1's private key and load it
         log=None
+        resources_dir="%s/resources"%dummy_mountpoint
 
         try:
             # decrypt blob1
             eobj=cpass.CryptoPassword(blob0)
-            encdata=util.load_file_contents("%s/resources/blob1.priv.enc"%dummy_mountpoint)
+            encdata=_load_file_contents("%s/blob1.priv.enc"%resources_dir)
             blob1=eobj.decrypt(encdata).decode()
         except Exception as e:
             raise Exception("Could not load 'blob1.priv.enc' or decrypt blob1 from blob0", None)
@@ -291,7 +451,7 @@ class BootProcessWKS:
         try:
             # load "live" chunks
             eobj=x509.CryptoKey(blob1, None)
-            echunks=util.load_file_contents("%s/resources/chunks.enc"%dummy_mountpoint)
+            echunks=_load_file_contents("%s/chunks.enc"%resources_dir)
             chunks=json.loads(eobj.decrypt(echunks))
         except Exception as e:
             raise Exception("Could not load 'chunks.enc' or decrypt chuks from blob1", None)
@@ -312,7 +472,7 @@ class BootProcessWKS:
         try:
             # load internal partition's password
             eobj=cpass.CryptoPassword(ifp)
-            data=util.load_file_contents("%s/resources/internal-pass.enc"%dummy_mountpoint)
+            data=_load_file_contents("%s/internal-pass.enc"%resources_dir)
         except Exception as e:
             raise Exception(f"Could not load the 'internal-pass.enc' file: {str(e)}", log)
 
@@ -415,33 +575,15 @@ class BootProcessWKS:
     def map_directories(self):
         """Map directories from the /data partition"""
         map_file="/opt/share/inseca-data-map.json"
-        data_map=json.load(open(map_file, "r"))
-        for key in data_map:
-            dest=data_map[key]
-            src="/data/%s"%key
-            if not os.path.exists(src):
-                if os.path.exists(dest):
-                    # initialize @src with @dest's contents before "replacing it" (via the bind mount)
-                    shutil.copytree(dest, src)
-                else:
-                    raise Exception("Could not bind 'data/%s': directories don't exist"%key)
-            os.makedirs(dest, exist_ok=True)
-            syslog.syslog(syslog.LOG_INFO, "Binding %s to %s"%(src, dest))
-            (status, out, err)=util.exec_sync(["mount", "--bind", "-o", "x-gvfs-hide", src, dest])
-            if status!=0:
-                raise Exception("Could not bind 'data/%s' to '%s': %s"%(src, dest, err))
+        data_map=_load_json_file(map_file)
+        _run_data_map_batches(data_map, _bind_data_directory)
 
     def unmap_directories(self):
         map_file="/opt/share/inseca-data-map.json"
         if not os.path.exists(map_file):
             return
-        data_map=json.load(open(map_file, "r"))
-        for key in data_map:
-            dest=data_map[key]
-            syslog.syslog(syslog.LOG_INFO, "Unbinding %s"%dest)
-            (status, out, err)=util.exec_sync(["umount", dest])
-            if status!=0:
-                raise Exception("Could not unbind '%s': %s"%(dest, err))
+        data_map=_load_json_file(map_file)
+        _run_data_map_batches(data_map, _unbind_data_directory)
 
     def prepare_shutdown(self):
         """Unmount partitions before shuting down"""
@@ -456,6 +598,41 @@ class BootProcessWKS:
 #
 # users settings' backup and restore parameters
 #
+@contextlib.contextmanager
+def _create_tgz_archive(filename):
+    """Context manager creating a gzip compressed TAR archive (as a TarFile object), compressed in parallel
+    using pigz if it is available. The archive file is removed in case of error"""
+    tar=None
+    proc=None
+    try:
+        pigz=shutil.which("pigz")
+        if pigz is None:
+            tar=tarfile.TarFile.gzopen(filename, "w")
+        else:
+            with open(filename, "wb") as out:
+                proc=subprocess.Popen([pigz, "-c"], stdin=subprocess.PIPE, stdout=out)
+            tar=tarfile.open(fileobj=proc.stdin, mode="w|")
+        yield tar
+
+        tar.close()
+        tar=None
+        if proc:
+            proc.stdin.close()
+            if proc.wait()!=0:
+                raise Exception("Could not compress archive (pigz exit code %d)"%proc.returncode)
+    except Exception:
+        if tar is not None:
+            try:
+                tar.close()
+            except Exception:
+                pass
+        if proc:
+            proc.stdin.close()
+            proc.wait()
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+
 def _backup_dconf(live_env, backup_filename):
     os.seteuid(live_env.uid)
     cenv=os.environ.copy()
@@ -494,37 +671,42 @@ def _backup_firefox(live_env, backup_filename):
             util.exec_sync(["killall", "firefox-bin"])
         except:
             pass
-        tar=tarfile.TarFile.gzopen(backup_filename, "w")
-        for entry in os.listdir(ffdir):
-            if os.path.isdir("%s/%s"%(ffdir, entry)):
-                # https://support.mozilla.org/en-US/kb/profiles-where-firefox-stores-user-data
-                for name in ["places.sqlite", "favicons.sqlite", "xulstore.json"]:
-                    targetfile="%s/%s/%s"%(ffdir, entry, name)
-                    if os.path.exists(targetfile):
-                        tar.add(targetfile, arcname=".mozilla/firefox/%s/%s"%(entry, name))
-        tar.close()
+        with _create_tgz_archive(backup_filename) as tar:
+            with os.scandir(ffdir) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        # https://support.mozilla.org/en-US/kb/profiles-where-firefox-stores-user-data
+                        for name in ["places.sqlite", "favicons.sqlite", "xulstore.json"]:
+                            targetfile="%s/%s"%(entry.path, name)
+                            if os.path.exists(targetfile):
+                                tar.add(targetfile, arcname=".mozilla/firefox/%s/%s"%(entry.name, name))
+
+_connection_type_re=re.compile(rb"^type=(.*)$", re.M)
+def _is_vpn_connection(path):
+    """Tell if the NetworkManager connection file @path defines a VPN (the 1st "type=" line decides).
+    The file is searched as is in memory, without being decoded or split in lines"""
+    with open(path, "rb") as fd:
+        try:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                match=_connection_type_re.search(mm)
+                return match is not None and match.group(1).rstrip(b"\r")==b"vpn"
+        except ValueError:
+            return False # empty file
 
+_mac_address_re=re.compile(r"^mac-address=.*$", re.M)
 def _backup_network(live_env, backup_filename):
     netdir="/etc/NetworkManager/system-connections"
     if os.path.exists(netdir):
-        tar=tarfile.TarFile.gzopen(backup_filename, "w")
-        for entry in os.listdir(netdir):
-            # we don't want VPN files!
-            try:
-                path="%s/%s"%(netdir, entry)
-                backup=True
-                contents=util.load_file_contents(path)
-                for line in contents.splitlines():
-                    if line.startswith("type="):
-                        (dummy, ctype)=line.split("=")
-                        if ctype=="vpn":
-                            backup=False
-                        break
-                if backup:
-                    tar.add(path, entry)
-            except:
-                pass
-        tar.close()
+        with os.scandir(netdir) as it:
+            entries=list(it)
+        with _create_tgz_archive(backup_filename) as tar:
+            for entry in entries:
+                # we don't want VPN files!
+                try:
+                    if not _is_vpn_connection(entry.path):
+                        tar.add(entry.path, entry.name)
+                except:
+                    pass
 
 def _restore_network(live_env, backup_filename):
     netdir="/etc/NetworkManager/system-connections"
@@ -568,28 +750,16 @@ def _restore_network(live_env, backup_filename):
         # replace MAC address in each config file, if there is one, otherwise do nothing
         syslog.syslog(syslog.LOG_INFO, "hwaddr: %s"%hwaddr)
         if hwaddr:
-            for filename in os.listdir(netdir):
-                path="%s/%s"%(netdir, filename)
-
-                restore=True
-                contents=util.load_file_contents(path)
-                for line in contents.splitlines():
-                    if line.startswith("type="):
-                        (dummy, ctype)=line.split("=")
-                        if ctype=="vpn":
-                            restore=False
-                        break
-
-                if restore:
-                    newlines=[]
-                    for line in contents.splitlines():
-                        if line.startswith("mac-address="):
-                            line="mac-address= %s"%hwaddr
-                        newlines+=[line]
-                    contents="\n".join(newlines)
-                    util.write_data_to_file(contents, path)
-                else:
+            with os.scandir(netdir) as it:
+                entries=list(it)
+            for entry in entries:
+                path=entry.path
+                if _is_vpn_connection(path):
                     os.remove(path)
+                else:
+                    contents=util.load_file_contents(path)
+                    contents=_mac_address_re.sub(lambda match: "mac-address= %s"%hwaddr, contents)
+                    util.write_data_to_file(contents, path)
 
         # force NetworkManager to reload configuration
         (status, out, err)=util.exec_sync(["nmcli", "connection", "reload"])
@@ -600,9 +770,8 @@ def _restore_network(live_env, backup_filename):
 def _backup_home_dir_as_archive(live_env, backup_filename, rel_data_dir):
     fullpath="%s/%s"%(live_env.home_dir, rel_data_dir)
     if os.path.exists(fullpath):
-        tar=tarfile.TarFile.gzopen(backup_filename, "w")
-        tar.add(fullpath, arcname=rel_data_dir)
-        tar.close()
+        with _create_tgz_archive(backup_filename) as tar:
+            tar.add(fullpath, arcname=rel_data_dir)
 
 def _restore_archive_in_home_dir(live_env, backup_filename):
     if os.path.exists(backup_filename):
@@ -691,13 +860,76 @@ _user_config_definition={
 }
 
 
+def _decrypt_and_extract_tar(eobj, encfile, dest_dir):
+    """Decrypt the @encfile TAR archive using the @eobj CryptoKey object and extract it in @dest_dir, the decrypted
+    data being directly streamed to the tar process.
+    Returns the (tar exit code, tar error message) tuple"""
+    # tar's error messages are written to a temporary file and not to a pipe, which would block tar
+    # (and the decryption) if it was full
+    with tempfile.TemporaryFile() as errfd:
+        proc=subprocess.Popen(["tar", "xf", "-", "-C", dest_dir], stdin=subprocess.PIPE, stderr=errfd)
+        try:
+            eobj.decrypt_file_to_fd(encfile, proc.stdin.fileno())
+        finally:
+            proc.stdin.close()
+            proc.wait()
+        errfd.seek(0)
+        err=errfd.read().decode()
+    return (proc.returncode, err)
+
+def _copy_tree_as_is(src, dst):
+    """Copy the contents of the @src directory into the @dst directory (merged with any existing contents),
+    keeping the files' type, permissions, ownership and times, as extracting a TAR archive of @src would"""
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as it:
+        entries=list(it)
+    for entry in entries:
+        target="%s/%s"%(dst.rstrip("/"), entry.name)
+        if entry.is_symlink():
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            _copy_tree_as_is(entry.path, target)
+            continue
+        else:
+            shutil.copy2(entry.path, target)
+        st=entry.stat(follow_symlinks=False)
+        os.chown(target, st.st_uid, st.st_gid, follow_symlinks=False)
+
+    # directory's attributes are set once its contents has been copied (for the modification time)
+    st=os.stat(src)
+    os.chown(dst, st.st_uid, st.st_gid)
+    shutil.copystat(src, dst)
+
+_utmp_record=struct.Struct("hi32s4s32s256shhiii4i20s") # struct utmp, see utmp(5)
+def _get_utmp_sessions():
+    """Get the (user name, terminal) of the user sessions, read directly from the utmp file
+    (same as the 'who' command, without having to execute it)"""
+    sessions=[]
+    with open("/run/utmp", "rb") as fd:
+        data=fd.read()
+    for record in _utmp_record.iter_unpack(data[:len(data)-len(data)%_utmp_record.size]):
+        (ut_type, ut_pid, ut_line, ut_id, ut_user)=record[:5]
+        if ut_type!=7 or ut_user[:1]==b"\0": # USER_PROCESS
+            continue
+        if ut_pid>0:
+            try:
+                os.kill(ut_pid, 0)
+            except ProcessLookupError:
+                continue # stale entry
+            except PermissionError:
+                pass
+        sessions.append((ut_user.split(b"\0", 1)[0].decode(), ut_line.split(b"\0", 1)[0].decode()))
+    return sessions
+
 class Environ:
     """Object to get information about a "workstation" or "admin" live environment"""
     def __init__(self):
         # determine live Linux type
         infos_file="/opt/share/keyinfos.json"
         try:
-            infos=json.load(open(infos_file, "r"))
+            infos=_load_json_file(infos_file)
             self._live_type=confs.BuildType(infos["build-type"])
         except:
             raise Exception("Invalid or missing keyinfos.json file")
@@ -713,11 +945,13 @@ class Environ:
         self._logged=None
         self._uid=None
         self._gid=None
+        self._config_dir=None
 
         self._unlocked=False
         self.update_unlocked_status()
 
         self.components_live_config_dir="/tmp/components-live-config"
+        self._components_config_dirs=None
         self.privdata_dir="/tmp/privdata"
 
     def update_unlocked_status(self):
@@ -743,14 +977,17 @@ class Environ:
     def logged(self):
         """Logged user name"""
         if self._logged is None:
-            (status, out, err)=util.exec_sync(["who"])
-            # output will be like "insecauser tty2 [...]" for Wayland or "insecauser :0 [...]" for X11
-            if status!=0:
-                raise Exception("Can't get the name of the connected user")
-            for line in out.splitlines():
-                parts=line.split()
-                if len(parts)>0 and (parts[1].startswith("tty") or parts[1]==":0"):
-                    self._logged=parts[0]                 # logged user name
+            try:
+                sessions=_get_utmp_sessions()
+            except OSError:
+                (status, out, err)=util.exec_sync(["who"])
+                # output will be like "insecauser tty2 [...]" for Wayland or "insecauser :0 [...]" for X11
+                if status!=0:
+                    raise Exception("Can't get the name of the connected user")
+                sessions=[parts[:2] for parts in map(str.split, out.splitlines()) if len(parts)>1]
+            for (user, line) in sessions:
+                if line.startswith("tty") or line==":0":
+                    self._logged=user                     # logged user name
                     entry=pwd.getpwnam(self._logged)
                     self._uid=entry.pw_uid                # logged user UID
                     self._gid=entry.pw_gid                # logged user GID
@@ -785,10 +1022,12 @@ class Environ:
         It is created if it does yet exist"""
         assert self._live_type==confs.BuildType.WKS
 
-        user_uuid=util.load_file_contents("%s/user_uuid"%_get_run_dir())
-        path="/internal/user-config/%s"%user_uuid
-        os.makedirs(path, exist_ok=True, mode=0o700)
-        return path
+        if self._config_dir is None:
+            user_uuid=util.load_file_contents("%s/user_uuid"%_get_run_dir())
+            path="/internal/user-config/%s"%user_uuid
+            os.makedirs(path, exist_ok=True, mode=0o700)
+            self._config_dir=path
+        return self._config_dir
 
     @property
     def default_profile_dir(self):
@@ -804,11 +1043,12 @@ class Environ:
         # look for the XAuthority file which can be /run/user/<uid>/gdm/Xauthority if Gnome runs over X11, or
         # /run/user/<uid>/.mutter-Xwaylandauth.* if Gnome runs over Wayland
         xauthset=False
-        for fname in os.listdir(f"/run/user/{self.uid}"):
-            if fname.startswith(".mutter-Xwaylandauth"):
-                os.environ["XAUTHORITY"]=f"/run/user/{self.uid}/{fname}"
-                xauthset=True
-                break
+        with os.scandir(f"/run/user/{self.uid}") as it:
+            for entry in it:
+                if entry.name.startswith(".mutter-Xwaylandauth"):
+                    os.environ["XAUTHORITY"]=entry.path
+                    xauthset=True
+                    break
         if not xauthset:
             os.environ["XAUTHORITY"]=f"/run/user/{self.uid}/gdm/Xauthority"
         return True
@@ -828,36 +1068,28 @@ class Environ:
 
         if os.path.exists("/privdata.tar.enc") and os.path.exists(privkey_file):
             eobj=x509.CryptoKey(util.load_file_contents(privkey_file), None)
-            edata=util.load_file_contents("/privdata.tar.enc")
-            resfile=eobj.decrypt(edata, return_tmpobj=True)
-            (status, out, err)=util.exec_sync(["tar", "xf", resfile.name, "-C", privtmp])
+            (status, err)=_decrypt_and_extract_tar(eobj, "/privdata.tar.enc", privtmp)
             if status!=0:
                 raise Exception("Error extracting privdata.tar.enc: %s"%err)
             syslog.syslog(syslog.LOG_INFO, "privdata.tar.enc extracted in %s"%privtmp)
 
         # extract each component's PRIVDATA file AS-IS in /
-        exec_env=os.environ.copy()
-        exec_env["PYTHONPATH"]=os.path.dirname(__file__)
-        components=os.listdir(privtmp)
-        for component in components:
-            if os.path.exists("%s/%s"%(privtmp, component)):
-                try:
-                    syslog.syslog(syslog.LOG_INFO, "Copying PRIVDATA for component '%s' to root"%component)
-                    tmptar=tempfile.NamedTemporaryFile()
-                    tmptar.close()
-                    tarobj=tarfile.open(tmptar.name, mode='w')
-                    tarobj.add("%s/%s"%(privtmp, component), arcname=".", recursive=True)
-                    tarobj.close()
-                    tarobj=tarfile.open(tmptar.name, mode='r')
-                    tarobj.extractall("/")
-                except Exception as e:
-                    syslog.syslog(syslog.LOG_ERR, "Failed to extact PRIVDATA for component '%s': %s"%(component, str(e)))
+        with os.scandir(privtmp) as it:
+            entries=[entry for entry in it if entry.is_dir()]
+        for entry in entries:
+            component=entry.name
+            try:
+                syslog.syslog(syslog.LOG_INFO, "Copying PRIVDATA for component '%s' to root"%component)
+                _copy_tree_as_is(entry.path, "/")
+            except Exception as e:
+                syslog.syslog(syslog.LOG_ERR, "Failed to extact PRIVDATA for component '%s': %s"%(component, str(e)))
 
     #
     # component's config
     #
     def extract_live_config_scripts(self):
         """Decrypt and extract the source code of all the component's configure scripts"""
+        self._components_config_dirs=None
         if os.path.exists(self.components_live_config_dir):
             syslog.syslog(syslog.LOG_WARNING, "CODEBUG: directory '%s' should not exist"%self.components_live_config_dir)
             shutil.rmtree(self.components_live_config_dir)
@@ -870,10 +1102,7 @@ class Environ:
 
         if os.path.exists("/live-config.tar.enc") and os.path.exists(privkey_file):
             eobj=x509.CryptoKey(util.load_file_contents(privkey_file), None)
-            edata=util.load_file_contents("/live-config.tar.enc")
-            resfile=eobj.decrypt(edata, return_tmpobj=True)
-
-            (status, out, err)=util.exec_sync(["tar", "xf", resfile.name, "-C", self.components_live_config_dir])
+            (status, err)=_decrypt_and_extract_tar(eobj, "/live-config.tar.enc", self.components_live_config_dir)
             if status!=0:
                 raise Exception("Error extracting live config. code")
             syslog.syslog(syslog.LOG_INFO, "live-config.tar.enc extracted in %s"%self.components_live_config_dir)
@@ -882,11 +1111,18 @@ class Environ:
         """Configure all the components for which there is a configure<stage>.py script"""
         assert isinstance(stage, int)
 
-        if os.path.exists(self.components_live_config_dir):
+        if self._components_config_dirs is None and os.path.exists(self.components_live_config_dir):
+            # list the components once for all the stages
+            with os.scandir(self.components_live_config_dir) as it:
+                self._components_config_dirs=[(entry.name, entry.path) for entry in it if entry.is_dir()]
+
+        if self._components_config_dirs is not None:
+            # the scripts are run one after the other: a component's script may depend on what
+            # another component's script of the same stage did (e.g. restarting docker)
             exec_env=os.environ.copy()
             exec_env["PYTHONPATH"]=os.path.dirname(__file__)
-            for component in os.listdir(self.components_live_config_dir):
-                script="%s/%s/configure%s.py"%(self.components_live_config_dir, component, stage)
+            for (component, path) in self._components_config_dirs:
+                script="%s/configure%s.py"%(path, stage)
                 # use the configure.py script, if any
                 if os.path.exists(script):
                     syslog.syslog(syslog.LOG_INFO, "Initializing component '%s', stage %d"%(component, stage))
@@ -905,19 +1141,17 @@ class Environ:
         ssh_privkey="%s/ssh_host_ed25519_key"%self._ssh_keys_dir
         ssh_pubkey="%s.pub"%ssh_privkey
         if not os.path.exists(ssh_privkey):
-            (status, out, err)=util.exec_sync(["ssh-keygen", "-q", "-N", "", "-t", "ed25519", "-f", ssh_privkey])
+            # ssh-keygen also writes the public key (without any comment) to @ssh_pubkey
+            (status, out, err)=util.exec_sync(["ssh-keygen", "-q", "-N", "", "-C", "", "-t", "ed25519", "-f", ssh_privkey])
             if status!=0:
                 self.events.add_exception_event("ssh-privatekey-generation", err)
-            (status, out, err)=util.exec_sync(["ssh-keygen", "-y", "-f", ssh_privkey])
-            if status!=0:
-                self.events.add_exception_event("ssh-publickey-generation", err)
-                os.remove(ssh_privkey)
-            util.write_data_to_file(out, ssh_pubkey)
+            else:
+                # same contents as 'ssh-keygen -y' would output
+                util.write_data_to_file(util.load_file_contents(ssh_pubkey).strip(), ssh_pubkey)
 
         # remove any existing SSH server key and deploy the specific keys
-        for filename in os.listdir("/etc/ssh"):
-            if filename.startswith("ssh_host_"):
-                os.remove("/etc/ssh/%s"%filename)
+        for path in glob.iglob("/etc/ssh/ssh_host_*"):
+            os.remove(path)
         shutil.copyfile(ssh_privkey, "/etc/ssh/ssh_host_ed25519_key")
         os.chmod("/etc/ssh/ssh_host_ed25519_key", 0o400)
         shutil.copyfile(ssh_pubkey, "/etc/ssh/ssh_host_ed25519_key.pub")
@@ -969,11 +1203,13 @@ class Environ:
         assert self._live_type==confs.BuildType.WKS
 
         config_dir=self.config_dir
+        with os.scandir(config_dir) as it:
+            present={entry.name for entry in it}
         definition=_user_config_definition
         for key in definition:
             try:
                 backup_filename="%s/%s"%(config_dir, key)
-                if os.path.exists(backup_filename):
+                if key in present:
                     self.events.add_info_event("backup", "Restoring %s"%key)
                     syslog.syslog(syslog.LOG_INFO, "Restore: %s"%key)
                     conf=definition[key]
@@ -989,11 +1225,11 @@ class Environ:
 
         config_dir=self.config_dir
         exp=None
-        for fname in os.listdir(config_dir):
-            try:
-                os.remove("%s/%s"%(config_dir, fname))
-            except Exception as e:
-                exp=e
+        try:
+            shutil.rmtree(config_dir)
+        except OSError as e:
+            exp=e
+        os.makedirs(config_dir, exist_ok=True, mode=0o700)
         util.write_data_to_file("", "%s/NO-BACKUP"%config_dir)
         if exp:
             raise exp
@@ -1001,21 +1237,40 @@ class Environ:
     #
     # Desktop Environment interactions
     #
+    def _exec_sync_as_logged(self, args):
+        """Run a command as the logged user if we are root (and as the current user otherwise), in the
+        same way as util.exec_sync().
+        The process' identity is changed directly when it is created, instead of through sudo (which requires
+        2 more processes and a PAM session)"""
+        if not util.is_run_as_root():
+            return util.exec_sync(args)
+
+        # minimal environment (as sudo would reset it), plus the UI related variables set by define_UI_environment()
+        entry=pwd.getpwnam(self.logged)
+        exec_env={
+            "PATH": "/usr/local/bin:/usr/bin:/bin",
+            "HOME": entry.pw_dir,
+            "USER": entry.pw_name,
+            "LOGNAME": entry.pw_name,
+            "SHELL": entry.pw_shell
+        }
+        for var in ["LANG", "XDG_RUNTIME_DIR", "DBUS_SESSION_BUS_ADDRESS", "WAYLAND_DISPLAY", "DISPLAY", "XAUTHORITY"]:
+            if var in os.environ:
+                exec_env[var]=os.environ[var]
+        sub=subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=exec_env,
+                             user=entry.pw_uid, group=entry.pw_gid, extra_groups=os.getgrouplist(entry.pw_name, entry.pw_gid))
+        (out, err)=sub.communicate()
+        return (sub.returncode, out.decode().rstrip("\r\n"), err.decode().rstrip("\r\n"))
+
     def notify(self, message):
         """Display a notification. 
         Make sure define_UI_environment() was called"""
-        args=["zenity", "--notification", "--text", message]
-        if util.is_run_as_root():
-            args=["sudo", "-H", "-u", self.logged, "DBUS_SESSION_BUS_ADDRESS=%s"%os.environ["DBUS_SESSION_BUS_ADDRESS"]]+args  
-        util.exec_sync(args)
+        self._exec_sync_as_logged(["zenity", "--notification", "--text", message])
 
     def user_setting_get(self, section, what):
         """Get a user setting. 
         Make sure define_UI_environment() was called"""
-        args=["gsettings", "get", section, what]
-        if util.is_run_as_root():
-            args=["sudo", "-H", "-u", self.logged, "DBUS_SESSION_BUS_ADDRESS=%s"%os.environ["DBUS_SESSION_BUS_ADDRESS"]]+args
-        (status, out, err)=util.exec_sync(args)
+        (status, out, err)=self._exec_sync_as_logged(["gsettings", "get", section, what])
         if status==0:
             return out
         else:
@@ -1024,56 +1279,90 @@ class Environ:
     def user_setting_set(self, section, what, value):
         """Change a user setting. 
         Make sure define_UI_environment() was called"""
-        args=["gsettings", "set", section, what, value]
-        if util.is_run_as_root():
-            args=["sudo", "-H", "-u", self.logged, "DBUS_SESSION_BUS_ADDRESS=%s"%os.environ["DBUS_SESSION_BUS_ADDRESS"]]+args
-        (status, out, err)=util.exec_sync(args)
+        (status, out, err)=self._exec_sync_as_logged(["gsettings", "set", section, what, value])
         if status!=0:
             syslog.syslog(syslog.LOG_ERR, "Could not define setting '%s %s' to '%s': %s"%(section, what, value, err))
 
+_insert_event_sql="INSERT INTO events (device_id, ts, type, data) VALUES (?, ?, ?, ?)"
+_max_unsent_info=32
+_sender_exit_timeout=10 # seconds
+
 class Events:
     def __init__(self):
         self._db_filename="/internal/events.db"
         self._conn=None
+        self._cur=None
 
         # define attestation file
         self._attestation_file="/internal/credentials/attestation.json"
+        self._attest=None
         self.device_id=None
 
         self.home_base_url="https://" # FIXME
+        self._session=requests.Session() # keep the connection open between events
 
         self._backlog=[] # store events while internal dir is not mounted
 
+        # events are sent home by a background thread, so recording an event never waits for the network
+        self._lock=threading.Lock() # protects the DB connection and self._unsent_info
+        self._send_request=threading.Event()
+        self._sender=None
+        self._exiting=False
+
+        # INFO events are only progress messages: they are stored right away, but only sent along with the
+        # next other event (or when there are too many of them)
+        self._unsent_info=0
+
     def _ensure_device_id(self):
         if not self.device_id:
-            attest=open(self._attestation_file).read()
-            adata=json.loads(attest)
-            self.device_id=adata["attestation"]["device-id"]
+            self._attest=json.loads(util.load_file_contents(self._attestation_file))
+            self.device_id=self._attest["attestation"]["device-id"]
 
     def _open_db(self):
         if self._conn:
             return True
         elif os.path.exists("/internal/resources/config.json"):
-            # open SQLite connection
-            self._conn=sqlite3.connect(self._db_filename, check_same_thread=False)
-            self._conn.isolation_level=None
-            self._init_db()
-            os.chmod(self._db_filename, 0o600)
+            # open SQLite connection, making sure the DB file and its -wal and -shm files
+            # (which also contain events) are only accessible by root
+            original_umask=os.umask(0o077)
+            try:
+                self._conn=sqlite3.connect(self._db_filename, check_same_thread=False)
+                os.chmod(self._db_filename, 0o600)
+                self._conn.isolation_level=None
+                self._cur=self._conn.cursor() # single cursor, always used with self._lock held
+                # no fsync() for each recorded event (WAL mode only requires it at checkpoints)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute("PRAGMA temp_store=MEMORY")
+                self._init_db()
+            finally:
+                os.umask(original_umask)
             syslog.syslog(syslog.LOG_INFO, "Connection opened to %s"%self._db_filename)
 
             # empty backlog
             syslog.syslog(syslog.LOG_INFO, "Backlog: %s"%self._backlog)
             if len(self._backlog)>0:
-                c=self._conn.cursor()
-                for (sql, params) in self._backlog:
-                    c.execute(sql, params)
+                self._executemany(_insert_event_sql, self._backlog)
                 self._backlog=[]
             return True
         else:
             return False
 
+    def _executemany(self, sql, rows):
+        """Run @sql for each of the @rows in a single transaction, rolled back in case of error
+        (self._lock must be held)"""
+        c=self._cur
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany(sql, rows)
+            c.execute("COMMIT")
+        except Exception:
+            if self._conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+
     def _init_db(self):
-        c=self._conn.cursor()
+        c=self._cur
         sql="""CREATE TABLE IF NOT EXISTS events (
                device_id TEXT NOT NULL,
                ts INTEGER NOT NULL,
@@ -1084,23 +1373,14 @@ class Events:
     def declare_device(self):
         try:
             self._ensure_device_id()
-            attest=open(self._attestation_file).read()
-            attest=json.loads(attest)
             ssh_key=util.load_file_contents("/etc/ssh/ssh_host_ed25519_key.pub")
-            data={"attestation": attest, "ssh-key": ssh_key}
+            data={"attestation": self._attest, "ssh-key": ssh_key}
             data=json.dumps(data)
             data=base64.b64encode(data.encode()).decode()
             now=datetime.datetime.utcnow()
             now=int(now.timestamp())
 
-            sql="INSERT INTO events (device_id, ts, type, data) VALUES (:device_id, :ts, :type, :data)"
-            params={"device_id": self.device_id, "ts": now, "type": "DECL", "data": data}
-            if self._open_db():
-                c=self._conn.cursor()
-                c.execute(sql, params)
-                self.send_events() # try now!
-            else:
-                self._backlog+=[[sql, params]]
+            self._record_events([(self.device_id, now, "DECL", data)])
         except Exception as e:
             syslog.syslog(syslog.LOG_ERR, "Failed to declare device: %s"%str(e))
 
@@ -1156,41 +1436,95 @@ class Events:
 
             data=json.dumps(event_data, sort_keys=True)
 
-            sql="INSERT INTO events (device_id, ts, type, data) VALUES (:device_id, :ts, :type, :data)"
-            params={"device_id": self.device_id, "ts": now, "type": event_type, "data": data}
-            if self._open_db():
-                c=self._conn.cursor()
-                c.execute(sql, params)
-                self.send_events() # try now!
-            else:
-                self._backlog+=[[sql, params]]
+            params=(self.device_id, now, event_type, data)
+            with self._lock:
+                send=True
+                if event_type=="INFO":
+                    self._unsent_info+=1
+                    send=self._unsent_info>=_max_unsent_info
+                if send:
+                    self._unsent_info=0
+            self._record_events([params], send=send)
         except Exception as e:
             syslog.syslog(syslog.LOG_ERR, "Failed to record event '%s': %s"%(event_type, str(e)))
 
+    def _record_events(self, events, send=True):
+        """Store some events in the DB, in a single transaction (or in the backlog if the DB is not yet available),
+        and have them sent home (along with any other pending event) if @send is True"""
+        with self._lock:
+            if not self._open_db():
+                self._backlog+=events
+                return
+            c=self._cur
+            if len(events)==1:
+                c.execute(_insert_event_sql, events[0])
+            else:
+                self._executemany(_insert_event_sql, events)
+
+        # try to send it now
+        if not send:
+            return
+        with self._lock:
+            if self._sender is None:
+                self._sender=threading.Thread(target=self._sender_loop, daemon=True)
+                self._sender.start()
+                # don't exit before the requested sendings have been done (for short lived processes)
+                atexit.register(self._stop_sender)
+        self._send_request.set()
+
+    def _sender_loop(self):
+        """Background thread sending the pending events when requested. After a failure, the sending is
+        retried after a delay (exponentially increased, up to 5 minutes), or when requested again"""
+        delay=None
+        while True:
+            self._send_request.wait(delay)
+            self._send_request.clear()
+            if self.send_events():
+                delay=None
+            else:
+                delay=min(max((delay or 0)*2, 1), 300)
+            if self._exiting and not self._send_request.is_set():
+                return
+
+    def _stop_sender(self):
+        """Make the background thread send the pending events one last time and wait for it to terminate
+        (at most _sender_exit_timeout seconds)"""
+        self._exiting=True
+        self._send_request.set()
+        self._sender.join(_sender_exit_timeout)
+
     def send_events(self):
-        """Send all pending events home"""
+        """Send all pending events home.
+        Returns True if all the events have been sent"""
         try:
-            if self._open_db():
-                events=[]
-                c=self._conn.cursor()
-                for row in c.execute("SELECT device_id, ts, type, data FROM events ORDER BY ts ASC"):
-                    events+=[[row[0], row[1], row[2], row[3]]]
-
-                for (device_id, ts, event_type, data) in events:
+            with self._lock:
+                if not self._open_db():
+                    syslog.syslog(syslog.LOG_ERR, "Failed to send events: /internal is not mounted")
+                    return False
+                c=self._cur
+                events=c.execute("SELECT rowid, device_id, ts, type, data FROM events ORDER BY ts ASC").fetchall()
+
+            sent=[]
+            try:
+                for (rowid, device_id, ts, event_type, data) in events:
                     if event_type=="DECL":
-                        r=requests.post("%s/%s"%(self.home_base_url, "/f3c8d053e5a3"), data=data, timeout=3)
+                        r=self._session.post("%s/%s"%(self.home_base_url, "/f3c8d053e5a3"), data=data, timeout=3)
                     else:
                         data=json.loads(data)
                         data["device-id"]=device_id
                         data["ts"]=ts
                         data["event-type"]=event_type
-                        r=requests.get("%s/%s"%(self.home_base_url, "/23a71f253d31"), params=data, timeout=3)
+                        r=self._session.get("%s/%s"%(self.home_base_url, "/23a71f253d31"), params=data, timeout=3)
                     if r.status_code==200:
-                        c.execute("DELETE FROM events WHERE ts=:ts AND type=:type", {"ts": ts, "type": event_type})
-            else:
-                syslog.syslog(syslog.LOG_ERR, "Failed to send events: /internal is not mounted")
+                        sent+=[(rowid,)]
+            finally:
+                # remove all the sent events at once
+                if sent:
+                    with self._lock:
+                        self._executemany("DELETE FROM events WHERE rowid=?", sent)
+            return len(sent)==len(events)
         except:
-            pass
+            return False
 
 
 #
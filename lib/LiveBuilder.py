@@ -25,8 +25,10 @@ import json
 import locale
 import datetime
 import os
+import errno
 import tarfile
 import shutil
+import concurrent.futures
 
 import namesgenerator
 import Utils as util
@@ -36,6 +38,19 @@ import Sync
 
 locale.setlocale(locale.LC_ALL, "")
 locale_dt=f"{locale.nl_langinfo(locale.D_FMT)} {locale.nl_langinfo(locale.T_FMT)}"
+_lib_dir=os.path.dirname(os.path.realpath(__file__))
+_sources_dir=os.path.dirname(_lib_dir)
+_tar_copybufsize=2*1024*1024 # instead of tarfile's default 16 KiB when copying files' contents
+
+def _now():
+    """Get the current UTC date and time, formatted for the build data file"""
+    return datetime.datetime.now(datetime.timezone.utc).strftime(locale_dt)
+
+def _write_tar(fileobj, base_dir, entries):
+    """Write a TAR archive of the @entries of the @base_dir directory to the @fileobj stream"""
+    with tarfile.open(fileobj=fileobj, mode="w|", bufsize=_tar_copybufsize, copybufsize=_tar_copybufsize) as tar:
+        for entry in entries:
+            tar.add("%s/%s"%(base_dir, entry), arcname=entry)
 
 def get_actual_mp(path):
     path=os.path.realpath(path)
@@ -43,6 +58,31 @@ def get_actual_mp(path):
         path=os.path.dirname(path)
     return path
 
+def _copy_file(src, dst):
+    """Copy the contents of the @src file to @dst using copy_file_range(), which lets the kernel copy the data
+    (or share it on filesystems supporting reflinks), or shutil.copyfile() if that's not supported"""
+    with open(src, "rb") as sfile, open(dst, "wb") as dfile:
+        try:
+            while os.copy_file_range(sfile.fileno(), dfile.fileno(), 1<<30)>0:
+                pass
+            return
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    shutil.copyfile(src, dst)
+
+def _install_deb(src, dst):
+    """Hard link (or copy if that's not possible) a .deb package in livebuild's packages directory,
+    the file is only read by livebuild"""
+    if os.path.lexists(dst):
+        os.remove(dst) # never write through an existing hard link
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _copy_file(src, dst)
+
 class Builder:
     def __init__(self, build_conf:str, dry_mode=False):
         gconf=confs.GlobalConfiguration()
@@ -52,8 +92,8 @@ class Builder:
         self._confdir=os.path.realpath(bconf.config_dir)
         self._bconf=bconf
         self._name=namesgenerator.get_random_name()
-        self._bindir=os.path.dirname(os.path.dirname(os.path.realpath(__file__)))+"/tools"
-        self._libdir=os.path.dirname(os.path.realpath(__file__))
+        self._bindir=_sources_dir+"/tools"
+        self._libdir=_lib_dir
         self._privdata_pubkey=None
         privdata_pubkey=bconf.privdata_pubkey
         if privdata_pubkey:
@@ -67,6 +107,20 @@ class Builder:
         self._build_data_file="%s/build-data"%(bconf.config_dir)
         self._components=bconf.components
         self._dry_mode=dry_mode # don't actually build if True
+        self._bdlog=None
+        self._mkdirs_cache=set() # directories already created
+
+    def _log(self, msg):
+        """Append @msg to the build data file, which is kept open (with buffering) until the end of the current
+        build step (see _close_build_data_file())"""
+        if self._bdlog is None:
+            self._bdlog=open(self._build_data_file, "a", buffering=1<<16)
+        self._bdlog.write(msg)
+
+    def _close_build_data_file(self):
+        if self._bdlog is not None:
+            self._bdlog.close()
+            self._bdlog=None
 
     @property
     def image_file(self):
@@ -91,12 +145,19 @@ class Builder:
     def prepare_build_dir(self):
         os.makedirs(self._livedir, exist_ok=True)
         self.clean_build_dir()
+        self._mkdirs_cache=set()
         self._packages_list_dir="%s/config/package-lists"%self._livedir
         self._packages_extra_dir="%s/config/packages.chroot"%self._livedir
         self._fs_dir="%s/config/includes.chroot"%self._livedir
 
         for entry in (self._packages_list_dir, self._packages_extra_dir, self._fs_dir):
-            os.makedirs(entry, exist_ok=True)
+            self._ensure_dir(entry)
+
+    def _ensure_dir(self, path):
+        """Create the @path directory (and its parents) if it has not already been created"""
+        if path not in self._mkdirs_cache:
+            os.makedirs(path, exist_ok=True)
+            self._mkdirs_cache.add(path)
 
     def _compute_userdata_parameters(self):
         """Compute all the user data parameters (required by some components during
@@ -114,7 +175,7 @@ class Builder:
             cpath=self._bconf.get_component_src_dir(component)
             cconf_file="%s/config.json"%cpath
             if os.path.exists(cconf_file):
-                data=json.load(open(cconf_file, "r"))
+                data=json.loads(util.load_file_contents(cconf_file, binary=True))
                 for param in data["userdata"]:
                     if data["userdata"][param]["type"]=="file":
                         if component not in all_params:
@@ -136,18 +197,10 @@ class Builder:
 
         if self._privdata_pubkey is None:
             raise Exception("Some components specified some PRIVDATA, but no encryption public key has been provided")
-        tar=tarfile.open(res_file, mode="w")
-        for entry in resources:
-            tar.add("%s/%s"%(res_dir, entry), arcname=entry)
-        tar.close()
-    
-        # encrypt TAR archive
-        data=util.load_file_contents(res_file, binary=True)
+        # create and encrypt the TAR archive as it is generated
         obj=x509.CryptoKey(None, self._privdata_pubkey)
-        tmp=obj.encrypt(data, return_tmpobj=True)
-        tmp.copy_to("%s.enc"%res_file)
+        obj.encrypt_to_file("%s.enc"%res_file, lambda fileobj: _write_tar(fileobj, res_dir, resources))
         if not self._dry_mode:
-            os.remove(res_file)
             shutil.rmtree(res_dir)
 
     def _encrypt_live_config_code(self):
@@ -163,121 +216,223 @@ class Builder:
             return
         if self._privdata_pubkey is None:
             raise Exception("Some components have specific init code, but no encryption public key has been provided")
-        tar=tarfile.open(res_file, mode="w")
-        for entry in resources:
-            tar.add("%s/%s"%(res_dir, entry), arcname=entry)
-        tar.close()
-    
-        # encrypt TAR archive
-        data=util.load_file_contents(res_file, binary=True)
+        # create and encrypt the TAR archive as it is generated
         obj=x509.CryptoKey(None, self._privdata_pubkey)
-        tmp=obj.encrypt(data, return_tmpobj=True)
-        tmp.copy_to("%s.enc"%res_file)
+        obj.encrypt_to_file("%s.enc"%res_file, lambda fileobj: _write_tar(fileobj, res_dir, resources))
         if not self._dry_mode:
-            os.remove(res_file)
             shutil.rmtree(res_dir)
 
+    def _get_component_debs(self, component, cpath, entries):
+        """Get the (source, target) files of the .deb packages associated to a component"""
+        dirs=self._bconf.get_component_blobs_dirs(component)
+        dirs+=[entry.path for entry in entries if entry.name=="packages.deb"]
+        debs=[]
+        packages_extra_dir=self._packages_extra_dir
+        for path in dirs:
+            with os.scandir(path) as it:
+                for dentry in it:
+                    if dentry.name.endswith(".deb"):
+                        # make sur file names end in "_amd64.deb" as this is a requirement of livebuild
+                        debs+=[(dentry.path, f"{packages_extra_dir}/{dentry.name[:-4]}_amd64.deb")]
+        return debs
+
+    def _plan_component_copy(self, component, cpath, entries):
+        """Walk the resources of a component to determine how to copy them in the live Linux's build directory.
+        Returns a (copy operations, targets) tuple where targets is a (files, directories) tuple of the sets of
+        files and directories the resources are copied to, or None if it can't be determined"""
+        ops=[]
+        files=set()
+        dirs=set()
+        add=files.add
+        livedir=self._livedir
+        fs_dir=self._fs_dir
+        def add_tree(src, dst):
+            # same as shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+            ops.append(("dir", src, dst))
+            dirs.add(dst)
+            with os.scandir(src) as it:
+                for sentry in it:
+                    target="%s/%s"%(dst, sentry.name)
+                    if sentry.is_symlink():
+                        ops.append(("symlink", sentry.path, target))
+                        add(target)
+                    elif sentry.is_dir():
+                        add_tree(sentry.path, target)
+                    else:
+                        ops.append(("file", sentry.path, target))
+                        add(target)
+
+        # livebuild's structural files first
+        for entry in entries:
+            fname=entry.name
+            if fname[0]=="_" and fname!="_ATTIC":
+                if entry.is_dir():
+                    add_tree(entry.path, "%s/%s"%(livedir, fname[1:]))
+                elif fname.endswith(".tar"):
+                    ops.append(("tar", entry.path, livedir))
+                    files=None
+
+        # any .deb file associated to that component
+        for src, target in self._get_component_debs(component, cpath, entries):
+            ops.append(("deb", src, target))
+            add(target)
+
+        # all other elements
+        for entry in entries:
+            fname=entry.name
+            path=entry.path
+            if fname=="packages.list":
+                target="%s/%s.list.chroot"%(self._packages_list_dir, component)
+                ops.append(("list", path, target))
+                add(target)
+
+            elif fname=="packages.deb":
+                pass # already done
+
+            elif fname in ["_ATTIC"]:
+                pass # ignore that file/directory
+
+            elif fname[0]=="_":
+                pass # already done
+
+            elif fname=="live-config":
+                # component's init code
+                add_tree(path, "%s/live-config/%s"%(fs_dir, component))
+
+            elif entry.is_dir():
+                # contents of dir to the root of the live image
+                add_tree(path, "%s/%s"%(fs_dir, fname))
+
+            else:
+                # ignore that file
+                pass
+        if files is None:
+            return (ops, None)
+        return (ops, (files, dirs))
+
+    def _copy_component(self, ops):
+        """Copy the resources of a component in the live Linux's build directory, as planned
+        by _plan_component_copy(), except for the directories' attributes (see _copy_component_dirs_stat())"""
+        for (op, src, dst) in ops:
+            if op=="dir":
+                os.makedirs(dst, exist_ok=True)
+            elif op=="file":
+                # replace any existing file or symlink as extracting a TAR archive would, and fail if @dst
+                # is a directory (shutil.copy2() would copy the file in it)
+                if os.path.islink(dst):
+                    os.remove(dst)
+                shutil.copyfile(src, dst)
+                shutil.copystat(src, dst)
+            elif op=="list":
+                shutil.copy(src, dst)
+            elif op=="symlink":
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.readlink(src), dst)
+            elif op=="deb":
+                _install_deb(src, dst)
+            elif op=="tar":
+                # stream mode: the archive is read once and its members are not kept in memory
+                with tarfile.open(src, "r|", bufsize=_tar_copybufsize, copybufsize=_tar_copybufsize) as tarobj:
+                    tarobj.extractall(dst)
+
+    def _copy_component_dirs_stat(self, ops):
+        """Set the attributes of the directories copied by _copy_component(), once their contents has
+        been copied (for the modification time)"""
+        for (op, src, dst) in reversed(ops):
+            if op=="dir":
+                shutil.copystat(src, dst)
+
+    def _run_component_prepare(self, component, cpath, entries):
+        """Run the prepare.sh/py scripts of a component"""
+        exec_env=os.environ.copy()
+        exec_env["SOURCES_DIR"]=_sources_dir
+        exec_env["BUILD_DIR"]=self._livedir
+        exec_env["BUILD_DATA_FILE"]=self._build_data_file
+        exec_env["COMPONENT_DIR"]=os.path.realpath(cpath)
+        exec_env["COMPONENT_BLOBS_DIR"]="|".join(self._bconf.get_component_blobs_dirs(component, ignore_missing=True))
+        exec_env["CONF_DIR"]=self._confdir
+        exec_env["LIVE_DIR"]=self._fs_dir
+        exec_env["LIBS_DIR"]=self._libdir
+        exec_env["PYTHONPATH"]=":".join(sys.path)
+        exec_env.update(self._bconf.l10n.to_env_dict())
+        for entry in entries:
+            if entry.name in ["prepare.sh", "prepare.py"]:
+                # the script appends to the build data file: write what has been logged so far before
+                self._close_build_data_file()
+
+                # pass the component's configuration in an in-memory file, which the script can open
+                # (and read as many times as needed) from its /dev/fd/ path
+                cconf=self._components[component]
+                fd=os.memfd_create("conf-data", os.MFD_CLOEXEC)
+                try:
+                    os.write(fd, json.dumps(cconf).encode())
+                    exec_env["CONF_DATA_FILE"]="/dev/fd/%d"%fd
+                    exec_env["PRIVDATA_DIR"]="%s/privdata/%s"%(self._fs_dir, component)
+
+                    (status, out, err)=util.exec_sync([entry.path], exec_env=exec_env, pass_fds=(fd,))
+                finally:
+                    os.close(fd)
+                if status!=0:
+                    raise Exception("Prepare script failed: %s"%err)
+
     def copy_resources(self):
         """Copy all the resources from each component in the live Linux's build directory"""
+        try:
+            self._copy_resources()
+        finally:
+            self._close_build_data_file()
+
+    def _copy_resources(self):
         # prepare file to append build data to
-        util.write_data_to_file("""\n=== building '%s' ===
+        self._log("""\n=== building '%s' ===
 Version: %s
 Name: %s
-"""%(self._bconf.id, self._bconf.version, self._name), self._build_data_file, append=True)
-
-        # copy each component
+"""%(self._bconf.id, self._bconf.version, self._name))
+
+        # group consecutive components which don't copy any file at the same place (directories can be
+        # shared, but not replaced by a file), so they can be copied concurrently while still letting a
+        # component override files from the previous ones.
+        # As prepare scripts may write anywhere, a component having some ends its batch: its scripts are
+        # run after its files have been copied and before the next components' files are
+        bconf=self._bconf
+        batches=[]
+        batch_targets=None
+        batch_closed=True
         for component in self._components:
-            print("Preparing component '%s'"%component)
-            cpath=self._bconf.get_component_src_dir(component)
-            component_files=os.listdir(cpath)
+            cpath=bconf.get_component_src_dir(component)
             if not os.path.isdir(cpath):
                 raise Exception("Component '%s' is not a directory"%component)
-
-            # copy livebuild's structural files first
-            for fname in component_files:
-                if fname[0]=="_" and fname!="_ATTIC":
-                    path="%s/%s"%(cpath, fname)
-                    if os.path.isdir(path):
-                        arname="%s/ar-%s"%(self._builddir, fname)
-                        shutil.make_archive(arname, "tar", path) # the ".tar" extension is automatically added
-                        target_dir="%s/%s"%(self._livedir, fname[1:])
-                        shutil.unpack_archive("%s.tar"%arname, target_dir, "tar")
-                        os.remove("%s.tar"%arname)
-                    elif fname.endswith(".tar"):
-                        shutil.unpack_archive(path, self._livedir, "tar")
-
-            # copy any .deb file associated to that component
-            for path in self._bconf.get_component_blobs_dirs(component):
-                for dfile in os.listdir(path):
-                    if dfile.endswith(".deb"):
-                        # make sur file names end in "_amd64.deb" as this is a requirement of livebuild
-                        target=f"{self._packages_extra_dir}/{dfile[:-4]}_amd64.deb"
-                        shutil.copyfile(f"{path}/{dfile}", target)
-
-            # copy all other elements
-            for fname in component_files:
-                path="%s/%s"%(cpath, fname)
-                if fname=="packages.list":
-                    shutil.copy(path, "%s/%s.list.chroot"%(self._packages_list_dir, component))
-
-                elif fname=="packages.deb":
-                    for dfile in os.listdir(path):
-                        if dfile.endswith(".deb"):
-                            # make sur file names end in "_amd64.deb" as this is a requirement of livebuild
-                            target="%s/%s_amd64.deb"%(self._packages_extra_dir, dfile[:-4])
-                            shutil.copyfile("%s/%s"%(path, dfile), target)
-
-                elif fname in ["_ATTIC"]:
-                    pass # ignore that file/directory
-
-                elif fname[0]=="_":
-                    pass # already done
-
-                elif fname=="live-config":
-                    # copy component's init code
-                    arname="%s/lc-%s"%(self._builddir, fname)
-                    shutil.make_archive(arname, "tar", path) # the ".tar" extension is automatically added
-                    shutil.unpack_archive("%s.tar"%arname, "%s/live-config/%s"%(self._fs_dir, component), "tar")
-                    os.remove("%s.tar"%arname)
-
-                elif os.path.isdir(path):
-                    # copy contents of dir to the root of the live image
-                    arname="%s/ar-%s.tar"%(self._builddir, fname)
-                    tarobj=tarfile.open(arname, "w", dereference=False)
-                    tarobj.add(path, arcname=fname)
-                    tarobj.close()
-                    tarobj=tarfile.open(arname, "r")
-                    tarobj.extractall(self._fs_dir)
-                    os.remove(arname)
-
-                else:
-                    # ignore that file
-                    pass
-
-            # run prepare.sh/py scripts
-            exec_env=os.environ.copy()
-            exec_env["SOURCES_DIR"]=os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-            exec_env["BUILD_DIR"]=self._livedir
-            exec_env["BUILD_DATA_FILE"]=self._build_data_file
-            exec_env["COMPONENT_DIR"]=os.path.realpath(cpath)
-            exec_env["COMPONENT_BLOBS_DIR"]="|".join(self._bconf.get_component_blobs_dirs(component, ignore_missing=True))
-            exec_env["CONF_DIR"]=self._confdir
-            exec_env["LIVE_DIR"]=self._fs_dir
-            exec_env["LIBS_DIR"]=os.path.realpath(self._libdir)
-            exec_env["PYTHONPATH"]=":".join(sys.path)
-            exec_env.update(self._bconf.l10n.to_env_dict())
-            for fname in component_files:
-                if fname in ["prepare.sh", "prepare.py"]:
-                    tmpfile=util.Temp()
-                    cconf=self._components[component]
-                    util.write_data_to_file(json.dumps(cconf), tmpfile.name)
-                    exec_env["CONF_DATA_FILE"]=tmpfile.name
-                    exec_env["PRIVDATA_DIR"]="%s/privdata/%s"%(self._fs_dir, component)
-
-                    path="%s/%s"%(cpath, fname)
-                    (status, out, err)=util.exec_sync([path], exec_env=exec_env)
-                    if status!=0:
-                        raise Exception("Prepare script failed: %s"%err)
+            with os.scandir(cpath) as it:
+                entries=list(it)
+            (ops, targets)=self._plan_component_copy(component, cpath, entries)
+            if not batch_closed and targets is not None and batch_targets is not None and \
+               targets[0].isdisjoint(batch_targets[0]) and targets[0].isdisjoint(batch_targets[1]) and \
+               targets[1].isdisjoint(batch_targets[0]):
+                batches[-1]+=[(component, cpath, entries, ops)]
+                batch_targets[0].update(targets[0])
+                batch_targets[1].update(targets[1])
+            else:
+                batches+=[[(component, cpath, entries, ops)]]
+                batch_targets=targets
+            batch_closed=any(entry.name in ["prepare.sh", "prepare.py"] for entry in entries)
+
+        # copy each batch of components, then set the attributes of the copied directories in the components'
+        # order (so the last component wins for the shared directories) and run the prepare scripts of the
+        # batch's last component (if any)
+        if batches:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(self._components))) as executor:
+                for batch in batches:
+                    futures=[]
+                    for (component, cpath, entries, ops) in batch:
+                        print("Preparing component '%s'"%component)
+                        futures+=[executor.submit(self._copy_component, ops)]
+                    for future in futures:
+                        future.result()
+                    for (component, cpath, entries, ops) in batch:
+                        self._copy_component_dirs_stat(ops)
+                    for (component, cpath, entries, ops) in batch:
+                        self._run_component_prepare(component, cpath, entries)
 
         # protect resources
         self._encrypt_privdata()
@@ -286,7 +441,7 @@ Name: %s
     def compute_user_data_specs(self):
         # aggregate component's extra info
         params=self._compute_userdata_parameters()
-        os.makedirs(os.path.dirname(self.userdata_specs_file), exist_ok=True)
+        self._ensure_dir(os.path.dirname(self.userdata_specs_file))
         util.write_data_to_file(json.dumps(params, sort_keys=True), self.userdata_specs_file)
 
     def _interrut_callback(self, child):
@@ -296,6 +451,12 @@ Name: %s
 
     def build(self):
         """Actual build of the live Linux based on the specified configuration"""
+        try:
+            self._build()
+        finally:
+            self._close_build_data_file()
+
+    def _build(self):
         self._bconf.validate()
 
         # check that the build directory does not have the noexec or nodev options (like /tmp)
@@ -318,10 +479,15 @@ Name: %s
         }
         path="%s/opt/share"%self._fs_dir
         fname="%s/keyinfos.json"%path
-        os.makedirs(path, exist_ok=True)
+        self._ensure_dir(path)
         util.write_data_to_file(json.dumps(data, indent=4, sort_keys=True), fname)
-        os.makedirs(os.path.dirname(self.image_infos_file), exist_ok=True)
-        util.write_data_to_file(json.dumps(data, indent=4, sort_keys=True), self.image_infos_file)
+        self._ensure_dir(os.path.dirname(self.image_infos_file))
+        if os.path.lexists(self.image_infos_file):
+            os.remove(self.image_infos_file)
+        try:
+            os.link(fname, self.image_infos_file)
+        except OSError:
+            shutil.copyfile(fname, self.image_infos_file)
 
         built_iso="%s/live-image-amd64.hybrid.iso"%self._livedir
 
@@ -361,8 +527,9 @@ Name: %s
 
         # build live image
         print("Build information is appended to '%s'"%self._build_data_file)
-        now=datetime.datetime.utcnow().strftime(locale_dt)
-        util.write_data_to_file("Started: %s UTC\n"%now, self._build_data_file, append=True)
+        now=_now()
+        self._log("Started: %s UTC\n"%now)
+        self._close_build_data_file() # written before the (long) live-build step
         print("Building Live image...")
         args=["docker", "run", "-m", "3192m", "--privileged", "--rm", "-v", "%s:/live"%self._livedir]+\
               proxy_args+\
@@ -379,14 +546,14 @@ Name: %s
         file.close()
 
         if status!=0 or not os.path.exists(built_iso):
-            now=datetime.datetime.utcnow().strftime(locale_dt)
+            now=_now()
             if self._build_interrupted:
-                util.write_data_to_file("Interrupted: %s UTC\n\n"%now, self._build_data_file, append=True)
+                self._log("Interrupted: %s UTC\n\n"%now)
                 # remove the build Docker container
                 util.exec_sync(["docker", "rm", "-f", self._bconf.id])
                 raise Exception("Build interrupted")
             else:
-                util.write_data_to_file("Failed: %s UTC\n\n"%now, self._build_data_file, append=True)
+                self._log("Failed: %s UTC\n\n"%now)
                 raise Exception("Could not build Live image, see the '%s' file"%buildlog)
 
         # customize and generate the final ISO file
@@ -404,14 +571,14 @@ Name: %s
                 os.chown(self.userdata_specs_file, uid, gid)
 
         # log info
-        now=datetime.datetime.utcnow().strftime(locale_dt)
-        util.write_data_to_file("Finished: %s UTC\n\n"%now, self._build_data_file, append=True)
+        now=_now()
+        self._log("Finished: %s UTC\n\n"%now)
 
     def _iso_image_customize(self, built_iso):
         """Customize the build ISO (initrd, etc)"""
         try:
             iso_dir=os.path.dirname(self.image_file)
-            os.makedirs(iso_dir, exist_ok=True)
+            self._ensure_dir(iso_dir)
 
             iso_contents_dir=None
             initrd_contents_dir=None
@@ -432,7 +599,7 @@ Name: %s
 
             # patch initrd's code
             patch_file=self._bindir+"/resources/initrd.patch"
-            (status, out, err)=util.exec_sync(["patch", "-p", "0"], stdin_data=util.load_file_contents(patch_file), cwd=initrd_contents_dir+"/main")
+            (status, out, err)=util.exec_sync(["patch", "-p", "0", "-i", patch_file], cwd=initrd_contents_dir+"/main")
             if status!=0:
                 raise Exception("Could not patch initrd's contents: %s"%err)
 
@@ -443,21 +610,27 @@ Name: %s
 
             # clean up the ISOLINUX config (remove everything after the #INSECA marker)
             conf_file="%s/isolinux/live.cfg"%iso_contents_dir
-            lines=[]
-            for line in util.load_file_contents(conf_file).splitlines():
-                if line.startswith("#INSECA"):
-                    break
-                lines+=[line]
-            util.write_data_to_file("\n".join(lines), conf_file)
+            data=util.load_file_contents(conf_file, binary=True)
+            if data.startswith(b"#INSECA"):
+                marker=0
+            else:
+                marker=data.find(b"\n#INSECA")
+            if marker>=0:
+                util.write_data_to_file(data[:marker], conf_file)
 
             # Grub. customization
             shutil.copyfile("%s/isolinux/splash.png"%iso_contents_dir, "%s/boot/grub/splash.png"%iso_contents_dir)
 
             # remove useless files
             livedir="%s/live"%iso_contents_dir
-            for fname in os.listdir(livedir):
-                if fname not in ("filesystem.squashfs", "initrd.img", "vmlinuz"):
-                    os.remove("%s/%s"%(livedir, fname))
+            keep=frozenset(("filesystem.squashfs", "initrd.img", "vmlinuz"))
+            with os.scandir(livedir) as it:
+                for entry in it:
+                    if entry.name not in keep:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.remove(entry.path)
 
             # 6) create the final ISO file
             conf_type=self._bconf.build_type
@@ -478,7 +651,7 @@ Name: %s
                     if dir:
                         shutil.rmtree(dir)
                 except Exception as e:
-                    util.write_data_to_file("Failed to clear directory '%s' where ISO was extracted: %s"%(dir, err), self._build_data_file, append=True)
+                    self._log("Failed to clear directory '%s' where ISO was extracted: %s\n"%(dir, e))
 
 
     def clean_build_dir(self):
@@ -64,7 +64,7 @@ def _exec_sync_interrupted(sig, dummy):
 _exec_sync_interrupted.proc=None
 _exec_sync_interrupted.callback=None
 
-def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_locale=False, timeout=None, interrupt_callback=None):
+def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_locale=False, timeout=None, interrupt_callback=None, pass_fds=()):
     """Run a command and wait for it to terminate, returns (exit code, stdout, stderr)
     Notes:
     - @stdin_data allows to specify some input data, while @as_bytes specifies if the output data
@@ -73,6 +73,7 @@ def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_
     - if @C_locale is True, then the LANG environment variable is set to "C" (useful when parsing output which
       repends on the locale)
     - if @timeout is specified, then the sub process is killed after that number of seconds and the return code is 250
+    - @pass_fds lists file descriptors to keep open in the sub process
     """
     if debug:
         logmsg="==> "
@@ -97,12 +98,12 @@ def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_
         errs=subprocess.PIPE
     if stdin_data==None:
         bdata=None
-        sub=subprocess.Popen(args, stdout=outs, stderr=errs, env=exec_env, cwd=cwd)
+        sub=subprocess.Popen(args, stdout=outs, stderr=errs, env=exec_env, cwd=cwd, pass_fds=pass_fds)
     else:
         bdata=stdin_data
         if isinstance(bdata, str):
             bdata=bdata.encode()
-        sub = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=outs, stderr=errs, env=exec_env, cwd=cwd)
+        sub = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=outs, stderr=errs, env=exec_env, cwd=cwd, pass_fds=pass_fds)
 
     # let process run
     try: